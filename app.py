@@ -1,18 +1,364 @@
-from flask import Flask, render_template_string, request, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, g
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import yfinance as yf
+import numpy as np
+import pandas as pd
 import requests
 import re
-from bs4 import BeautifulSoup
+import atexit
+import bisect
+import click
+import copy
+import csv
+import fcntl
+import gzip
+import hashlib
+import hmac
+import io
 import json
+import math
 import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
-from flask import abort
+from html.parser import HTMLParser
+from flask import abort, send_from_directory
 import gspread
 from google.oauth2.service_account import Credentials
 
+try:
+    import brotli  # 任意（未インストールならgzipのみ）
+except ImportError:
+    brotli = None
+
+try:
+    from yfinance.exceptions import YFTickerMissingError  # yfinance 0.2.41以降
+except ImportError:
+    YFTickerMissingError = None
+# history の raise_errors は1.xで非推奨（警告だけで動作は同じ）。銘柄の有無の確認にだけ使う
+warnings.filterwarnings('ignore', message="'raise_errors' deprecated", category=DeprecationWarning)
+
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'  # セッション用の秘密鍵
+# 静的ファイルは内容ハッシュ付きURLで配信するため長期キャッシュさせる
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = int(os.environ.get('STATIC_MAX_AGE', str(365 * 24 * 3600)))
+
+# テンプレート（templates/*.html）は起動時にコンパイルしてJinjaのキャッシュに載せる
+PAGE_TEMPLATES = ['base.html', 'dashboard.html', 'jp_stocks.html', 'us_stocks.html',
+                  'funds.html', 'gold.html', 'cash.html']
+
+_static_versions = {}
+
+def static_url(filename):
+    """内容ハッシュをクエリに付けた静的ファイルURL（更新時のみURLが変わる）"""
+    version = _static_versions.get(filename)
+    if version is None:
+        try:
+            with open(os.path.join(app.static_folder, filename), 'rb') as f:
+                version = hashlib.sha256(f.read()).hexdigest()[:12]
+        except OSError:
+            version = ''
+        _static_versions[filename] = version
+    return url_for('static', filename=filename, v=version) if version else url_for('static', filename=filename)
+
+app.jinja_env.globals['static_url'] = static_url
+
+def warm_templates():
+    """ページテンプレートを事前にコンパイルする"""
+    for name in PAGE_TEMPLATES:
+        app.jinja_env.get_template(name)
+
+warm_templates()
+
+# --- メトリクス ---
+# ルート・外部取得ごとの所要時間のヒストグラムとエラー数、キャッシュの参照結果を数え、
+# Prometheusのテキスト形式で /metrics に出す。値はワーカー（プロセス）ごとに持つ。
+# 設定すると /metrics に Bearer トークンが必要。未設定なら誰でも読めるので、本番では設定するか
+# リバースプロキシで /metrics を外から見えないようにする
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # 秒
+
+metrics_registry = []
+
+def _by_labels(item):
+    return tuple(str(value) for value in item[0])
+
+class Counter:
+    """ラベルの組ごとに増えるだけの値"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}  # ラベルの値のタプル -> 値
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        for labels, value in sorted(self.values().items(), key=_by_labels):
+            yield self.name, labels, None, value
+
+class Histogram:
+    """ラベルの組ごとの値の分布（バケットごとの件数・合計・件数）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # ラベルの値のタプル -> [バケットごとの件数（最後は+Inf）..., 合計]
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)  # value <= 上限 となる最初のバケット
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            entry[i] += 1
+            entry[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = sorted(((labels, list(entry)) for labels, entry in self._values.items()), key=_by_labels)
+        for labels, entry in items:
+            count = 0
+            for bound, n in zip(self.buckets + (math.inf,), entry):
+                count += n
+                yield f'{self.name}_bucket', labels, ('le', '+Inf' if bound == math.inf else repr(bound)), count
+            yield f'{self.name}_sum', labels, None, entry[-1]
+            yield f'{self.name}_count', labels, None, count
+
+class Gauge:
+    """出力するときに collect() で求める値（collect はラベルの値のタプル -> 値 を返す）"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labels, collect):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.collect = collect
+        metrics_registry.append(self)
+
+    def samples(self):
+        for labels, value in sorted(self.collect().items(), key=_by_labels):
+            yield self.name, labels, None, value
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _metric_labels(names, values, extra):
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in pairs) + '}'
+
+def render_metrics():
+    """登録済みのメトリクスをPrometheusのテキスト形式にする"""
+    lines = []
+    for metric in metrics_registry:
+        lines.append(f'# HELP {metric.name} {metric.help_text}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, extra, value in metric.samples():
+            lines.append(f'{name}{_metric_labels(metric.labels, labels, extra)} {value}')
+    return '\n'.join(lines) + '\n'
+
+http_request_duration = Histogram('http_request_duration_seconds', 'ルートごとのリクエスト処理時間', ('method', 'route'))
+http_requests = Counter('http_requests_total', 'ルート・ステータスごとのリクエスト数', ('method', 'route', 'status'))
+upstream_duration = Histogram('upstream_request_duration_seconds', '外部取得1回ごとの所要時間',
+                              ('upstream', 'operation'))
+upstream_errors = Counter('upstream_errors_total', '外部取得の失敗数', ('upstream', 'operation', 'error'))
+cache_requests = Counter('cache_requests_total', 'キャッシュの参照数（hit / stale / miss）', ('cache', 'result'))
+
+def _cache_hit_ratios():
+    totals = {}
+    for (cache, result), n in cache_requests.values().items():
+        hits, total = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (n if result == 'hit' else 0), total + n)
+    return {(cache,): hits / total for cache, (hits, total) in totals.items() if total}
+
+cache_hit_ratio = Gauge('cache_hit_ratio', 'キャッシュごとの参照に占めるhitの割合', ('cache',), _cache_hit_ratios)
+
+@contextmanager
+def upstream_timer(upstream, operation):
+    """外部取得1回の所要時間と失敗を記録する（応答の検証まで含めて囲む）"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        upstream_errors.inc(upstream, operation, type(e).__name__)
+        raise
+    finally:
+        upstream_duration.observe(time.perf_counter() - start, upstream, operation)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        http_request_duration.observe(time.perf_counter() - started, request.method, route)
+        http_requests.inc(request.method, route, str(response.status_code))
+    return response
+
+# --- レスポンスの圧縮 ---
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))  # これより小さいレスポンスは圧縮しない（バイト）
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))  # gzipの圧縮レベル（1〜9）
+COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))  # brotliの品質（0〜11）
+COMPRESS_CACHE_SIZE = int(os.environ.get('COMPRESS_CACHE_SIZE', 128))  # 圧縮済みレスポンスの保持数
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/plain', 'application/json', 'application/javascript',
+                      'text/javascript', 'image/svg+xml')
+
+class CompressionMiddleware:
+    """Accept-Encodingに応じてレスポンスをbrotli/gzipで圧縮するWSGIミドルウェア
+
+    同じ本文（静的ファイルや描画結果のキャッシュから返した内容）は圧縮済みのバイト列を使い回す。
+    ストリーミング（SSE）やContent-Lengthのないレスポンスはそのまま流す。
+    """
+
+    def __init__(self, wsgi_app, min_size, level, brotli_quality, cache_size):
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # (encoding, 本文のハッシュ) -> 圧縮済みの本文
+        self._lock = threading.Lock()
+
+    def negotiate(self, accept_encoding):
+        """使える符号化のうちクライアントのq値が最も高いもの（同じならbr、なければNone）"""
+        accepted = {}
+        for part in accept_encoding.split(','):
+            name, _, params = part.strip().partition(';')
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.0
+            accepted[name.strip().lower()] = q
+        # q値が最も高いものを選び、同じならbrを優先する
+        candidates = (['br'] if brotli is not None else []) + ['gzip']
+        best = max(candidates, key=lambda name: accepted.get(name, accepted.get('*', 0)))
+        return best if accepted.get(best, accepted.get('*', 0)) > 0 else None
+
+    def compress(self, body, encoding):
+        key = (encoding, hashlib.sha1(body).digest())
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+        cache_requests.inc('compression', 'miss' if cached is None else 'hit')
+        if cached is not None:
+            return cached
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(body, compresslevel=self.level, mtime=0)
+        with self._lock:
+            self._cache[key] = compressed
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return compressed
+
+    @staticmethod
+    def _tag_etag(headers, encoding):
+        """ETagに符号化の接尾辞を付ける（圧縮前と別の表現として扱わせる）"""
+        return [(name, value[:-1] + f'-{encoding}"' if name.lower() == 'etag' and value.endswith('"') else value)
+                for name, value in headers]
+
+    @staticmethod
+    def _add_vary(headers):
+        vary = [value for name, value in headers if name.lower() == 'vary']
+        if not any('accept-encoding' in value.lower() for value in vary):
+            headers = headers + [('Vary', 'Accept-Encoding')]
+        return headers
+
+    def _compressible(self, status, headers):
+        if not status.startswith('200'):
+            return False
+        names = {name.lower(): value for name, value in headers}
+        if 'content-encoding' in names or 'content-length' not in names:
+            return False
+        if 'no-transform' in names.get('cache-control', ''):
+            return False
+        content_type = names.get('content-type', '').split(';')[0].strip().lower()
+        return content_type in COMPRESSIBLE_TYPES
+
+    def __call__(self, environ, start_response):
+        encoding = self.negotiate(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        tagged = False
+        if if_none_match:
+            # 今回と同じ符号化で圧縮したときのETagだけ、接尾辞を外してアプリに渡す
+            stripped = if_none_match.replace(f'-{encoding}"', '"')
+            tagged = stripped != if_none_match
+            environ['HTTP_IF_NONE_MATCH'] = stripped
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            return lambda data: captured.setdefault('written', []).append(data)
+
+        app_iter = self.wsgi_app(environ, capture)
+        status, headers = captured['status'], captured['headers']
+        if status.startswith('304'):
+            # 保存されている圧縮済みの200と同じETag・Varyを返す
+            if tagged:
+                headers = self._tag_etag(headers, encoding)
+            headers = self._add_vary(headers)
+        if not self._compressible(status, headers) or captured.get('written'):
+            write = start_response(status, headers, captured['exc_info'])
+            for data in captured.get('written', []):
+                write(data)
+            return app_iter
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        headers = [(name, value) for name, value in headers if name.lower() != 'content-length']
+        if len(body) >= self.min_size:
+            body = self.compress(body, encoding)
+            headers = self._tag_etag(headers, encoding)
+            headers.append(('Content-Encoding', encoding))
+        headers = self._add_vary(headers)
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers, captured['exc_info'])
+        return [body]
+
+app.wsgi_app = CompressionMiddleware(app.wsgi_app, COMPRESS_MIN_SIZE, COMPRESS_LEVEL,
+                                     COMPRESS_BROTLI_QUALITY, COMPRESS_CACHE_SIZE)
 
 # Flask-Loginのセットアップ
 login_manager = LoginManager()
@@ -36,142 +382,1990 @@ def load_user(user_id):
         return User(user_id)
     return None
 
+JST = timezone(timedelta(hours=9))  # 日本時間
+
 # Google Sheets設定
 GSHEET_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 GSHEET_CRED_FILE = 'credentials.json'  # サービスアカウント認証ファイル
 GSHEET_SPREADSHEET_ID = '1CRA4YrK6lJjKm_L1h7xR_u8Q9thwURu62-6VUTnW6Qg'  # 手順案内で取得
 
-# ユーザーごとにシート名を分ける
+class SheetsPool:
+    """認証情報・認可済みクライアント・スプレッドシート・ワークシートをプロセス内で使い回す
+
+    アクセストークンは認可済みセッションが期限切れ時に自動で更新する。
+    """
+
+    def __init__(self, cred_file, scopes, spreadsheet_id):
+        self.cred_file = cred_file
+        self.scopes = scopes
+        self.spreadsheet_id = spreadsheet_id
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}  # シート名 -> Worksheet
+        self._lock = threading.RLock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                creds = Credentials.from_service_account_file(self.cred_file, scopes=self.scopes)
+                self._client = gspread.authorize(creds)
+            return self._client
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._spreadsheet is None:
+                self._spreadsheet = self.client().open_by_key(self.spreadsheet_id)
+            return self._spreadsheet
+
+    def worksheet(self, title, create=False):
+        """ワークシートを取得（create=Trueなら無ければ作成）"""
+        with self._lock:
+            ws = self._worksheets.get(title)
+            if ws is None:
+                sh = self.spreadsheet()
+                try:
+                    ws = sh.worksheet(title)
+                except gspread.exceptions.WorksheetNotFound:
+                    if not create:
+                        raise
+                    ws = sh.add_worksheet(title=title, rows=1, cols=1)
+                self._worksheets[title] = ws
+            return ws
+
+    def invalidate(self, title=None):
+        """ワークシートが消された・認証が切れた場合などに保持しているハンドルを捨てる"""
+        with self._lock:
+            if title is not None:
+                self._worksheets.pop(title, None)
+                return
+            self._client = None
+            self._spreadsheet = None
+            self._worksheets.clear()
+
+sheets_pool = SheetsPool(GSHEET_CRED_FILE, GSHEET_SCOPES, GSHEET_SPREADSHEET_ID)
+
 def get_gsheet_client():
-    creds = Credentials.from_service_account_file(GSHEET_CRED_FILE, scopes=GSHEET_SCOPES)
-    return gspread.authorize(creds)
+    return sheets_pool.client()
+
+def _handle_sheets_error(sheet_name, e):
+    """Sheets APIエラー時のハンドル破棄"""
+    if isinstance(e, gspread.exceptions.APIError) and e.response.status_code in (401, 403):
+        sheets_pool.invalidate()
+    else:
+        sheets_pool.invalidate(sheet_name)
 
+# ユーザーごとにシート名を分ける
 def get_data_file():
     if current_user.is_authenticated:
         return f'asset_data_{current_user.id}.json'
     return 'asset_data_guest.json'
 
-def load_data():
-    """Google Sheetsからユーザーごとの資産情報を読み込み"""
-    if not current_user.is_authenticated:
-        return {
-            'jp_stocks': [], 'us_stocks': [], 'funds': [], 'crypto': [], 'gold_qty': 0, 'cash_items': [], 'last_updated': None
-        }
-    gc = get_gsheet_client()
-    sh = gc.open_by_key(GSHEET_SPREADSHEET_ID)
-    sheet_name = f"{current_user.id}_data"
-    try:
-        ws = sh.worksheet(sheet_name)
-        val = ws.acell('A1').value
-        if val:
-            return json.loads(val)
-    except Exception:
-        pass
+def empty_data():
     return {
         'jp_stocks': [], 'us_stocks': [], 'funds': [], 'crypto': [], 'gold_qty': 0, 'cash_items': [], 'last_updated': None
     }
 
+def _fetch_user_a1(user_id):
+    """A1セルのJSONからユーザーの資産情報を読み込み（失敗時は例外）"""
+    sheet_name = f"{user_id}_data"
+    try:
+        with upstream_timer('sheets', 'read'):
+            ws = sheets_pool.worksheet(sheet_name)
+            val = ws.acell('A1').value
+        return json.loads(val) if val else empty_data()
+    except Exception as e:
+        _handle_sheets_error(sheet_name, e)
+        raise
+
+def _read_user_a1(user_id):
+    """A1セルのJSONからユーザーの資産情報を読み込み"""
+    try:
+        return _fetch_user_a1(user_id)
+    except Exception:
+        return empty_data()
+
+def _write_user_a1(user_id, data):
+    """A1セルにJSONで保存（失敗時は例外）"""
+    sheet_name = f"{user_id}_data"
+    try:
+        with upstream_timer('sheets', 'write'):
+            ws = sheets_pool.worksheet(sheet_name, create=True)
+            ws.update('A1', json.dumps(data, ensure_ascii=False))
+    except Exception as e:
+        _handle_sheets_error(sheet_name, e)
+        raise
+
+# --- 行単位レイアウト（1銘柄1行） ---
+# GSHEET_LAYOUT=rows で {user}_rows シートに資産クラスごとの列範囲へ1行ずつ保存する
+GSHEET_LAYOUT = os.environ.get('GSHEET_LAYOUT', 'a1')  # 'a1' または 'rows'
+SHEET_ROW_BLOCKS = {
+    # 資産クラス: (開始列, 終了列, 項目)
+    'jp_stocks': ('A', 'D', ['code', 'name', 'qty', 'price']),
+    'us_stocks': ('F', 'I', ['symbol', 'name', 'qty', 'price']),
+    'funds': ('K', 'M', ['name', 'qty', 'price']),
+    'cash_items': ('O', 'P', ['label', 'amount']),
+    'meta': ('R', 'S', ['key', 'value']),  # 金の数量・最終更新日時などその他の項目（値はJSON）
+}
+SHEET_ROWS_INITIAL = 1000
+SHEET_ROWS_COLS = 19  # A〜S列
+
+_sheet_rows_state = {}  # user_id -> {block: [行]}（最後に読み書きしたシートの内容）
+_sheet_rows_lock = threading.Lock()
+
+def _rows_sheet_name(user_id):
+    return f"{user_id}_rows"
+
+def _data_to_rows(data):
+    """資産情報を資産クラスごとの行に変換"""
+    blocks = {}
+    for block, (_, _, fields) in SHEET_ROW_BLOCKS.items():
+        if block == 'meta':
+            continue
+        blocks[block] = [[item.get(field, '') for field in fields] for item in data.get(block, [])]
+    blocks['meta'] = [[key, json.dumps(value, ensure_ascii=False)]
+                      for key, value in sorted(data.items()) if key not in SHEET_ROW_BLOCKS]
+    return blocks
+
+def _rows_to_data(blocks):
+    """資産クラスごとの行を資産情報に戻す"""
+    data = empty_data()
+    for block, (_, _, fields) in SHEET_ROW_BLOCKS.items():
+        if block == 'meta':
+            continue
+        data[block] = [dict(zip(fields, row)) for row in blocks.get(block, []) if any(v != '' for v in row)]
+    for row in blocks.get('meta', []):
+        if row and row[0] != '':
+            data[row[0]] = json.loads(row[1])
+    return data
+
+def _read_rows_state(ws):
+    """シートから全資産クラスの行を1回のbatch_getで読み込み"""
+    ranges = [f"{start}2:{end}" for start, end, _ in SHEET_ROW_BLOCKS.values()]
+    value_ranges = ws.batch_get(ranges, value_render_option=gspread.utils.ValueRenderOption.unformatted)
+    blocks = {}
+    for block, value_range in zip(SHEET_ROW_BLOCKS, value_ranges):
+        width = len(SHEET_ROW_BLOCKS[block][2])
+        rows = [list(row) + [''] * (width - len(row)) for row in value_range]
+        while rows and not any(v != '' for v in rows[-1]):
+            rows.pop()
+        blocks[block] = rows
+    return blocks
+
+def _diff_row_updates(old_blocks, new_blocks):
+    """前回の内容と比べて変わった行だけの更新範囲を作る（連続する行は1つの範囲にまとめる）"""
+    updates = []
+    for block, (start, end, fields) in SHEET_ROW_BLOCKS.items():
+        old_rows = old_blocks.get(block, [])
+        new_rows = new_blocks.get(block, [])
+        blank = [''] * len(fields)
+        run_start, run_values = None, []
+        for i in range(max(len(old_rows), len(new_rows)) + 1):
+            old_row = old_rows[i] if i < len(old_rows) else blank
+            new_row = new_rows[i] if i < len(new_rows) else blank
+            if old_row != new_row:
+                if run_start is None:
+                    run_start = i
+                run_values.append(new_row)
+            elif run_start is not None:
+                updates.append({
+                    'range': f"{start}{run_start + 2}:{end}{run_start + 1 + len(run_values)}",
+                    'values': run_values,
+                })
+                run_start, run_values = None, []
+    return updates
+
+def _read_user_rows(user_id):
+    """行単位レイアウトのシートからユーザーの資産情報を読み込み"""
+    sheet_name = _rows_sheet_name(user_id)
+    try:
+        with upstream_timer('sheets', 'read'):
+            ws = sheets_pool.worksheet(sheet_name)
+            blocks = _read_rows_state(ws)
+    except Exception as e:
+        _handle_sheets_error(sheet_name, e)
+        return empty_data()
+    with _sheet_rows_lock:
+        _sheet_rows_state[user_id] = blocks
+    return _rows_to_data(blocks)
+
+def _create_rows_sheet(sh, sheet_name):
+    ws = sh.add_worksheet(title=sheet_name, rows=SHEET_ROWS_INITIAL, cols=SHEET_ROWS_COLS)
+    ws.batch_update([{'range': f"{start}1:{end}1", 'values': [fields]}
+                     for start, end, fields in SHEET_ROW_BLOCKS.values()])
+    return ws
+
+def _write_user_rows(user_id, data):
+    """変わった行だけを1回のbatch_updateで保存（失敗時は例外）"""
+    sheet_name = _rows_sheet_name(user_id)
+    new_blocks = _data_to_rows(data)
+    try:
+        with upstream_timer('sheets', 'write'):
+            try:
+                ws = sheets_pool.worksheet(sheet_name)
+            except gspread.exceptions.WorksheetNotFound:
+                ws = _create_rows_sheet(sheets_pool.spreadsheet(), sheet_name)
+            with _sheet_rows_lock:
+                old_blocks = _sheet_rows_state.get(user_id)
+            if old_blocks is None:
+                old_blocks = _read_rows_state(ws)
+            updates = _diff_row_updates(old_blocks, new_blocks)
+            if not updates:
+                return
+            needed = max(len(rows) for rows in new_blocks.values()) + 2
+            if needed > ws.row_count:
+                ws.add_rows(max(needed - ws.row_count, SHEET_ROWS_INITIAL))
+            ws.batch_update(updates)
+    except Exception as e:
+        _handle_sheets_error(sheet_name, e)
+        with _sheet_rows_lock:
+            _sheet_rows_state.pop(user_id, None)  # 次回は読み直してから差分を取る
+        raise
+    with _sheet_rows_lock:
+        _sheet_rows_state[user_id] = new_blocks
+
+def _read_user_data(user_id):
+    """Google Sheetsからユーザーの資産情報を読み込み"""
+    if GSHEET_LAYOUT == 'rows':
+        return _read_user_rows(user_id)
+    return _read_user_a1(user_id)
+
+def _write_user_data(user_id, data):
+    """Google Sheetsにユーザーの資産情報を保存（失敗時は例外）"""
+    if GSHEET_LAYOUT == 'rows':
+        _write_user_rows(user_id, data)
+    else:
+        _write_user_a1(user_id, data)
+
+def _fetch_rows_state(user_id):
+    """行単位レイアウトのシートの内容（シートが無ければNone、読み込み失敗時は例外）"""
+    sheet_name = _rows_sheet_name(user_id)
+    try:
+        with upstream_timer('sheets', 'read'):
+            return _read_rows_state(sheets_pool.worksheet(sheet_name))
+    except gspread.exceptions.WorksheetNotFound:
+        return None
+    except Exception as e:
+        _handle_sheets_error(sheet_name, e)
+        raise
+
+def migrate_a1_to_rows(user_id, force=False):
+    """A1セルのJSONを行単位レイアウトへ移行（行単位のシートに既にデータがあればforce時のみ上書きし、それ以外はNone）
+
+    読み込みに失敗した場合は例外にする（空のデータで行単位のシートを消さないため）。
+    """
+    data = _fetch_user_a1(user_id)
+    blocks = _fetch_rows_state(user_id)
+    if blocks is not None and any(blocks.values()) and not force:
+        return None
+    with _sheet_rows_lock:
+        _sheet_rows_state.pop(user_id, None)
+    _write_user_rows(user_id, data)
+    return data
+
+@app.cli.command('migrate-sheets')
+@click.option('--force', is_flag=True, help='行単位のシートに既にデータがあっても上書きする')
+def migrate_sheets_command(force):
+    """全ユーザーの資産情報をA1形式から行単位レイアウトへ移行する"""
+    for user_id in USERS:
+        try:
+            data = migrate_a1_to_rows(user_id, force=force)
+        except Exception as e:
+            print(f"{user_id}: 読み込み・保存に失敗したためスキップしました ({e!r})")
+            continue
+        if data is None:
+            print(f"{user_id}: {_rows_sheet_name(user_id)} に既にデータがあるためスキップしました（上書きは --force）")
+            continue
+        counts = ', '.join(f"{block}={len(data.get(block, []))}" for block in SHEET_ROW_BLOCKS if block != 'meta')
+        print(f"{user_id}: {counts}")
+
+# --- 保存の遅延書き込み（write-behind） ---
+# 有効にするとメモリ上の資産情報が正本になるため、gunicornのワーカーは1つで運用すること
+WRITE_BEHIND = os.environ.get('WRITE_BEHIND', '0') == '1'
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 5))  # 書き込み間隔（秒）
+WRITE_BEHIND_LOG = os.environ.get('WRITE_BEHIND_LOG', 'write_behind.log')  # 未反映の変更の記録先
+
+class WriteBehindQueue:
+    """保存をメモリ上の正本に反映してすぐ返し、ユーザーごとに1回にまとめてSheetsへ書き込む
+
+    未反映の変更はログファイルに追記しておき、プロセスが落ちても次回起動時に書き込む。
+    """
+
+    def __init__(self, writer, interval, log_path):
+        self._writer = writer
+        self.interval = interval
+        self.log_path = log_path
+        self._docs = {}  # user_id -> 最新の資産情報
+        self._dirty = set()  # 未反映のuser_id
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._recover()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def get(self, user_id):
+        """メモリ上の正本を返す（無ければNone）"""
+        self.start()
+        with self._lock:
+            doc = self._docs.get(user_id)
+        return copy.deepcopy(doc) if doc is not None else None
+
+    def put(self, user_id, data):
+        self.start()
+        doc = copy.deepcopy(data)
+        line = json.dumps({'user': user_id, 'data': doc}, ensure_ascii=False)
+        with self._lock:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._docs[user_id] = doc
+            self._dirty.add(user_id)
+
+    def flush(self):
+        """未反映の変更をユーザーごとに1回の書き込みでSheetsへ反映"""
+        with self._flush_lock:
+            with self._lock:
+                pending = {user_id: self._docs[user_id] for user_id in self._dirty}
+                self._dirty.clear()
+            failed = set()
+            for user_id, doc in pending.items():
+                try:
+                    self._writer(user_id, doc)
+                except Exception as e:
+                    print('Google Sheets保存エラー:', e)
+                    failed.add(user_id)
+            with self._lock:
+                self._dirty |= failed
+                self._compact_log()
+
+    def _compact_log(self):
+        """ログを未反映のユーザーの最新版だけに書き直す"""
+        tmp_path = self.log_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for user_id in self._dirty:
+                f.write(json.dumps({'user': user_id, 'data': self._docs[user_id]}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.log_path)
+
+    def _recover(self):
+        """前回のプロセスで反映できなかった変更をログから読み戻す"""
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中で落ちた行
+                self._docs[entry['user']] = entry['data']
+                self._dirty.add(entry['user'])
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+write_behind = WriteBehindQueue(_write_user_data, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_LOG)
+
+# --- 保有のキー索引 ---
+HOLDING_KEYS = {'jp_stocks': 'code', 'us_stocks': 'symbol', 'funds': 'name', 'cash_items': 'label'}
+
+def normalize_holding_key(key, value):
+    """保有のキーをそろえる（文字列にして前後の空白を除き、銘柄コード・ティッカーは大文字）"""
+    value = str(value).strip()
+    return value.upper() if key in ('code', 'symbol') else value
+
+class Holdings:
+    """1つの資産クラスの保有をキーで引けるようにした入れ物
+
+    dictの挿入順で並びを保ち、追加・更新・削除・検索をO(1)で行う。同じキーの行は1つにまとめる。
+    """
+
+    def __init__(self, key, items=()):
+        self.key = key
+        self._items = {}  # キー -> 保有
+        for item in items:
+            self.upsert(item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def __contains__(self, key):
+        return normalize_holding_key(self.key, key) in self._items
+
+    def get(self, key):
+        return self._items.get(normalize_holding_key(self.key, key))
+
+    def upsert(self, item):
+        """同じキーがあれば項目を上書き（並び順はそのまま）、なければ末尾に追加する。追加したらTrue"""
+        key = item[self.key] = normalize_holding_key(self.key, item[self.key])
+        existing = self._items.get(key)
+        if existing is None:
+            self._items[key] = item
+            return True
+        existing.update(item)
+        return False
+
+    def delete(self, key):
+        """削除できたらTrue"""
+        return self._items.pop(normalize_holding_key(self.key, key), None) is not None
+
+    def to_list(self):
+        return list(self._items.values())
+
+def holdings(data, asset):
+    """資産情報の資産クラスをHoldingsとして返す（リクエスト内では同じものを使い、save_dataでリストに戻す）"""
+    cache = g.setdefault('holdings', {})
+    entry = cache.get(asset)
+    if entry is None or entry[0] is not data:
+        entry = (data, Holdings(HOLDING_KEYS[asset], data.get(asset, [])))
+        cache[asset] = entry
+    return entry[1]
+
+def _store_holdings(data):
+    """変更したHoldingsを資産情報のリストに書き戻す"""
+    for asset, (document, index) in g.get('holdings', {}).items():
+        if document is data:
+            data[asset] = index.to_list()
+
+# --- ユーザーデータのキャッシュ ---
+DATA_CACHE_TTL = float(os.environ.get('DATA_CACHE_TTL', 0))  # リクエストをまたぐ読み込みキャッシュ（秒、0で無効）
+
+_data_cache = {}  # user_id -> (data, cached_at)
+_data_cache_lock = threading.Lock()
+
+def _load_user_data(user_id):
+    """ユーザーの資産情報を読み込み（DATA_CACHE_TTL内なら前回の読み込み結果を使う）"""
+    if DATA_CACHE_TTL > 0:
+        with _data_cache_lock:
+            entry = _data_cache.get(user_id)
+        if entry is not None and time.time() - entry[1] < DATA_CACHE_TTL:
+            cache_requests.inc('user_data', 'hit')
+            return copy.deepcopy(entry[0])
+        cache_requests.inc('user_data', 'miss')
+    if WRITE_BEHIND:
+        data = write_behind.get(user_id)
+        if data is not None:
+            return data
+    data = _read_user_data(user_id)
+    if DATA_CACHE_TTL > 0:
+        with _data_cache_lock:
+            _data_cache[user_id] = (copy.deepcopy(data), time.time())
+    return data
+
+def _fetch_user_data(user_id):
+    """キャッシュを使わずにユーザーの資産情報を読み込み（読み込み失敗時は例外、シートが無ければ空）"""
+    if WRITE_BEHIND:
+        data = write_behind.get(user_id)
+        if data is not None:
+            return data
+    if GSHEET_LAYOUT == 'rows':
+        blocks = _fetch_rows_state(user_id)
+        return _rows_to_data(blocks) if blocks is not None else empty_data()
+    try:
+        return _fetch_user_a1(user_id)
+    except gspread.exceptions.WorksheetNotFound:
+        return empty_data()
+
+def invalidate_user_data(user_id):
+    with _data_cache_lock:
+        _data_cache.pop(user_id, None)
+
+def load_data():
+    """Google Sheetsからユーザーごとの資産情報を読み込み（1リクエストにつき1回）"""
+    if not current_user.is_authenticated:
+        return empty_data()
+    if 'user_data' not in g:
+        g.user_data = _load_user_data(current_user.id)
+    return g.user_data
+
 def save_data(data):
     """Google Sheetsにユーザーごとの資産情報を保存"""
-    from datetime import datetime, timezone, timedelta
-    jst = timezone(timedelta(hours=9))
-    data['last_updated'] = datetime.now(jst).strftime('%Y-%m-%d %H:%M:%S')
+    _store_holdings(data)
+    data['last_updated'] = datetime.now(JST).strftime('%Y-%m-%d %H:%M:%S')
+    data['revision'] = data.get('revision', 0) + 1  # 保存ごとに増える版数（ETag用）
     if not current_user.is_authenticated:
         return
-    gc = get_gsheet_client()
-    sh = gc.open_by_key(GSHEET_SPREADSHEET_ID)
-    sheet_name = f"{current_user.id}_data"
-    try:
+    g.user_data = data
+    price_stream.update_symbols(current_user.id, holding_symbols(data))
+    if WRITE_BEHIND:
+        write_behind.put(current_user.id, data)
+    else:
         try:
-            ws = sh.worksheet(sheet_name)
-        except gspread.exceptions.WorksheetNotFound:
-            ws = sh.add_worksheet(title=sheet_name, rows=1, cols=1)
-        ws.update('A1', json.dumps(data, ensure_ascii=False))
-    except Exception as e:
-        print('Google Sheets保存エラー:', e)
+            _write_user_data(current_user.id, data)
+        except Exception as e:
+            print('Google Sheets保存エラー:', e)
+    invalidate_user_data(current_user.id)
+    fragment_cache.invalidate_user(current_user.id)
 
-def get_jp_stock_info(code):
-    """日本株の情報を取得"""
-    try:
-        ticker = yf.Ticker(f"{code}.T")
+# --- 描画結果のキャッシュ ---
+# ダッシュボードのHTML・JSONは (ユーザー, 版数, 相場の世代) が同じなら同じ内容になるので使い回す。
+FRAGMENT_CACHE_TTL = float(os.environ.get('FRAGMENT_CACHE_TTL', 60))  # 秒（0で無効）
+FRAGMENT_CACHE_MAXSIZE = int(os.environ.get('FRAGMENT_CACHE_MAXSIZE', 256))
+
+class FragmentCache:
+    """描画済みのHTML・JSONのキャッシュ（TTL・LRU）"""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (value, cached_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] >= self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+        cache_requests.inc('fragment', 'miss' if entry is None else 'hit')
+        return None if entry is None else entry[0]
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        """ユーザーの資産情報が保存されたときに呼ぶ"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_TTL, FRAGMENT_CACHE_MAXSIZE)
+
+_market_generation = 0  # 株価・為替・金価格のいずれかが変わるたびに増える
+_market_generation_lock = threading.Lock()
+
+def market_changed():
+    """相場が更新されたことを記録する（古い世代の描画結果は使われなくなり、LRU・TTLで消える）"""
+    global _market_generation
+    with _market_generation_lock:
+        _market_generation += 1
+
+def market_generation():
+    """現在の相場の世代（他のワーカーの更新はリクエストの開始時に sync_quote_store で取り込む）"""
+    return _market_generation
+
+def cached_fragment(data, name, build):
+    """描画結果を (ユーザー, 版数, 相場の世代) ごとに再利用する"""
+    generation = market_generation()
+    key = (current_user.id, data.get('revision') or data.get('last_updated'), generation, name)
+    value = fragment_cache.get(key)
+    if value is None:
+        value = build()
+        # 描画中に相場が変わった場合は古い値で作った可能性があるので保存しない
+        if market_generation() == generation:
+            fragment_cache.set(key, value)
+    return value
+
+# --- ワーカー共有の相場ストア ---
+# gunicornの各ワーカーが取得した株価・為替・金価格を、同じホストの全ワーカーで使う。
+# SQLite（WALモード）の表に1相場1行・取得時刻付きで書き込み、読み込みはメモリ上の写しから行う。
+# 他のワーカーが書き込んだとき（PRAGMA data_version が変わったとき）だけ、書き込み順の連番で
+# 前回以降に変わった行を読んで写しを更新する。確認はリクエストごとに1回（sync_quote_store）と、
+# get・snapshot の呼び出し時に行い、キャッシュの参照（peek）では行わない。
+QUOTE_STORE_FILE = os.environ.get('QUOTE_STORE_FILE', 'quote_store.sqlite3')
+QUOTE_STORE_TIMEOUT = float(os.environ.get('QUOTE_STORE_TIMEOUT', 5))  # 書き込みロックの待ち時間（秒）
+
+class SharedQuoteStore:
+    """全ワーカーで共有する相場ストア（(種類, キー) -> (価格, 名前, 取得時刻)）"""
+
+    def __init__(self, path, on_change=None):
+        self.path = path
+        self.on_change = on_change  # 他のワーカーの書き込みを取り込んだときに呼ぶ関数
+        self._entries = {}  # kind -> {key: (price, name, updated_at)}
+        self._seq = 0  # 写しに取り込んだ書き込みの連番
+        self._conn = None
+        self._pid = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """プロセスごとの接続（fork後は開き直す、ロック内で呼ぶ）"""
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=QUOTE_STORE_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # priceは型を指定しない（整数の金価格は整数のまま戻す）
+            conn.execute("""CREATE TABLE IF NOT EXISTS quotes (
+                kind TEXT NOT NULL, key TEXT NOT NULL, price NOT NULL, name TEXT, updated_at REAL NOT NULL,
+                seq INTEGER NOT NULL, PRIMARY KEY (kind, key)) WITHOUT ROWID""")
+            conn.execute('CREATE INDEX IF NOT EXISTS quotes_seq ON quotes (seq)')
+            self._conn = conn
+            self._pid = os.getpid()
+            self._version = None
+        return self._conn
+
+    def sync(self):
+        """他のワーカーが書き込んでいれば写しを読み直す"""
+        with self._lock:
+            try:
+                conn = self._connect()
+                version = conn.execute('PRAGMA data_version').fetchone()[0]
+                if version == self._version:
+                    return
+                rows = conn.execute('SELECT kind, key, price, name, updated_at, seq FROM quotes WHERE seq > ?',
+                                    (self._seq,)).fetchall()
+            except sqlite3.Error as e:
+                print(f"Quote store read error: {e}")
+                return
+            changed = False
+            for kind, key, price, name, updated_at, seq in rows:
+                entries = self._entries.setdefault(kind, {})
+                entry = (price, name, updated_at)
+                changed = changed or entries.get(key) != entry
+                entries[key] = entry
+                self._seq = max(self._seq, seq)
+            self._version = version
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    def get(self, kind, key):
+        """(価格, 名前, 取得時刻)、なければNone"""
+        self.sync()
+        return self.peek(kind, key)
+
+    def peek(self, kind, key):
+        """get と同じだが、他のワーカーの書き込みは確認しない（写しを読むだけ）"""
+        return self._entries.get(kind, {}).get(key)
+
+    def snapshot(self, kind, max_age):
+        """max_age秒以内に取得された価格（key→price）"""
+        self.sync()
+        now = time.time()
+        with self._lock:
+            return {key: price for key, (price, _, updated_at) in self._entries.get(kind, {}).items()
+                    if now - updated_at < max_age}
+
+    def put(self, kind, prices, names=None, updated_at=None):
+        """価格（key→price）を1回のトランザクションで書き込む（より新しい値は上書きしない）"""
+        updated_at = time.time() if updated_at is None else updated_at
+        names = names or {}
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    seq = conn.execute('SELECT COALESCE(MAX(seq), 0) + 1 FROM quotes').fetchone()[0]
+                    conn.executemany("""INSERT INTO quotes (kind, key, price, name, updated_at, seq)
+                        VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (kind, key) DO UPDATE SET price = excluded.price,
+                        name = excluded.name, updated_at = excluded.updated_at, seq = excluded.seq
+                        WHERE excluded.updated_at >= quotes.updated_at""",
+                        [(kind, key, price, names.get(key), updated_at, seq) for key, price in prices.items()])
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as e:
+                # 書き込めなくてもこのワーカーの中では使う
+                print(f"Quote store write error: {e}")
+            entries = self._entries.setdefault(kind, {})
+            for key, price in prices.items():
+                current = entries.get(key)
+                if current is None or current[2] <= updated_at:
+                    entries[key] = (price, names.get(key), updated_at)
+
+quote_store = SharedQuoteStore(QUOTE_STORE_FILE, on_change=market_changed)
+
+@app.before_request
+def sync_quote_store():
+    """リクエストごとに1回、他のワーカーの書き込みを取り込む"""
+    quote_store.sync()
+
+# --- 外部取得の耐障害性 ---
+# 上流（Yahoo Finance・為替・田中貴金属）ごとにサーキットブレーカーを置く。
+# 接続・読み込みのタイムアウトを短くし、一時的な失敗はジッター付きの間隔で数回だけ再試行する。
+# 失敗が続いた上流はしばらく呼ばずにすぐ失敗させ、呼び出し側は前回取得できた値を使う。
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3))  # 秒
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 5))  # 秒
+UPSTREAM_TIMEOUT = (UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)  # requests用
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))  # 一時的な失敗の再試行回数
+UPSTREAM_RETRY_BACKOFF = float(os.environ.get('UPSTREAM_RETRY_BACKOFF', 0.3))  # 再試行の待ちの上限の基準（秒、回ごとに倍）
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 4))  # タイムアウトを指定できない呼び出し用
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))  # この回数続けて失敗したら開く
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))  # 開いてから試しに呼ぶまで（秒）
+UPSTREAM_DATA_ERRORS = (ValueError, KeyError, IndexError, TypeError)  # 上流は応答したが値が無い・形式が違う
+
+upstream_pool = ThreadPoolExecutor(max_workers=UPSTREAM_POOL_SIZE, thread_name_prefix='upstream')
+
+class UpstreamError(Exception):
+    """上流から値が返ってこなかった（一時的な失敗として扱う）"""
+
+class CircuitOpenError(Exception):
+    """ブレーカーが開いているため上流を呼ばなかった"""
+
+def is_transient_error(e):
+    """再試行・ブレーカーの失敗に数える失敗か（タイムアウト・接続エラー・5xx・429）"""
+    if isinstance(e, UPSTREAM_DATA_ERRORS):
+        return False
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if status is not None:
+        return status >= 500 or status == 429
+    return True
+
+def _format_time(t):
+    return datetime.fromtimestamp(t, JST).strftime('%Y-%m-%d %H:%M:%S') if t else None
+
+class CircuitBreaker:
+    """上流1つ分のサーキットブレーカー（closed → open → half_open → closed）
+
+    closed: 通常どおり呼ぶ。一時的な失敗は再試行し、それでも失敗したら1回と数える。
+    open: failure_threshold 回続けて失敗したら reset_timeout 秒のあいだ呼ばずに CircuitOpenError。
+    half_open: reset_timeout 後に1回だけ試し、成功すれば closed、失敗すれば再び open。
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0  # 連続失敗回数
+        self.opened_at = None
+        self.last_error = None
+        self.last_failure_at = None
+        self.last_success_at = None
+        self.calls = 0
+        self.rejected = 0  # 開いていたため呼ばなかった回数
+        self._trial_at = None  # half_open の試しの呼び出しを始めた時刻
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"Circuit breaker {self.name}: {self.state} -> {state}")
+            self.state = state
+
+    def _acquire(self):
+        """呼んでよければ再試行回数を返す（half_open では試しの1回だけ、再試行なし）"""
+        now = time.time()
+        with self._lock:
+            if self.state == 'open' and now - self.opened_at >= self.reset_timeout:
+                self._set_state('half_open')
+                self._trial_at = None
+            if self.state == 'closed':
+                self.calls += 1
+                return UPSTREAM_RETRIES
+            # 試しの呼び出しが戻ってこない場合に備え、reset_timeout 経てば次の試しを許す
+            if self.state == 'half_open' and (self._trial_at is None or now - self._trial_at >= self.reset_timeout):
+                self._trial_at = now
+                self.calls += 1
+                return 0
+            self.rejected += 1
+        upstream_rejected.inc(self.name)
+        raise CircuitOpenError(f'{self.name} circuit is open')
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.last_success_at = time.time()
+            self._set_state('closed')
+
+    def record_failure(self, error):
+        with self._lock:
+            self.failures += 1
+            self.last_error = repr(error)
+            self.last_failure_at = time.time()
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.opened_at = self.last_failure_at
+                self._set_state('open')
+
+    def trip(self, error):
+        """失敗を1回記録し、回数に関係なくすぐ開く（処理が戻ってこないとき）"""
+        with self._lock:
+            self.failures += 1
+            self.last_error = repr(error)
+            self.last_failure_at = self.opened_at = time.time()
+            self._set_state('open')
+
+    def _should_retry(self, error, attempt, retries):
+        """失敗を記録し、もう一度試すなら True"""
+        if not is_transient_error(error):
+            self.record_success()  # 上流は応答している
+            return False
+        if attempt < retries:
+            return True
+        self.record_failure(error)
+        return False
+
+    def _backoff(self, attempt):
+        return random.uniform(0, UPSTREAM_RETRY_BACKOFF * 2 ** attempt)  # full jitter
+
+    def call(self, func, *args, timeout=None, labels=None):
+        """func(*args) を再試行・ブレーカー付きで呼ぶ
+
+        timeout を指定すると、タイムアウトを持たない処理でもその秒数で待つのをやめる（処理は裏で続く）。
+        待ちきれなかったときは再試行せずにブレーカーを開く。固まった処理が upstream_pool の
+        スレッドを占めたままなので、重ねて投げるとプールが埋まってしまう。
+        labels は func の中の upstream_timer と同じ (upstream, operation)。
+        """
+        retries = self._acquire()
+        for attempt in range(retries + 1):
+            try:
+                if timeout is None:
+                    result = func(*args)
+                else:
+                    future = upstream_pool.submit(func, *args)
+                    try:
+                        result = future.result(timeout=timeout)
+                    except FutureTimeoutError as e:
+                        future.cancel()  # まだ始まっていなければ取り消す
+                        # 待つのをやめた分は upstream_timer が終わる前なのでここで数える
+                        if labels is not None:
+                            upstream_errors.inc(*labels, 'TimeoutError')
+                        self.trip(e)
+                        raise
+            except FutureTimeoutError:
+                raise
+            except Exception as e:
+                if self._should_retry(e, attempt, retries):
+                    time.sleep(self._backoff(attempt))
+                    continue
+                raise
+            self.record_success()
+            return result
+
+    def status(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'calls': self.calls,
+                'rejected': self.rejected,
+                'last_error': self.last_error,
+                'last_failure_at': _format_time(self.last_failure_at),
+                'last_success_at': _format_time(self.last_success_at),
+                'retry_at': _format_time(self.opened_at + self.reset_timeout) if self.state == 'open' else None,
+            }
+
+breakers = {name: CircuitBreaker(name, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+            for name in ('yahoo', 'yahoo_fx', 'tanaka')}
+
+BREAKER_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+upstream_rejected = Counter('upstream_circuit_rejected_total', 'ブレーカーが開いていて呼ばなかった回数', ('breaker',))
+upstream_circuit_state = Gauge('upstream_circuit_state', 'サーキットブレーカーの状態（0=closed, 1=half_open, 2=open）',
+                               ('breaker',), lambda: {(name,): BREAKER_STATE_VALUES[b.state] for name, b in breakers.items()})
+
+# --- 株価キャッシュ ---
+QUOTE_CACHE_TTL = int(os.environ.get('QUOTE_CACHE_TTL', 300))  # 秒
+QUOTE_CACHE_MAXSIZE = int(os.environ.get('QUOTE_CACHE_MAXSIZE', 1024))
+
+class QuoteCache:
+    """銘柄ごとの株価キャッシュ（TTL・LRU・stale-while-revalidate）"""
+
+    def __init__(self, ttl, maxsize, on_change=None, store=None, kind=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.on_change = on_change  # 値が変わったときに呼ぶ関数
+        self.store = store  # 全ワーカー共有のストア（kindはストア上の種類名）
+        self.kind = kind
+        self._entries = OrderedDict()  # key -> (value, fetched_at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _shared(self, key):
+        """共有ストアの写しにある値（ロックの外で呼ぶ）"""
+        return self.store.peek(self.kind, key) if self.store is not None else None
+
+    def _entry(self, key, shared):
+        """手元の値と共有ストアの値のうち新しい方（ロック内で呼ぶ）"""
+        entry = self._entries.get(key)
+        if shared is not None and (entry is None or shared[2] > entry[1]):
+            price, name, fetched_at = shared
+            value = {'price': price} if name is None else {'name': name, 'price': price}
+            entry = self._entries[key] = (value, fetched_at)
+            self._trim()
+        return entry
+
+    def _trim(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get(self, key, loader):
+        """キャッシュから取得。期限切れなら古い値を返しつつ裏で1回だけ更新する"""
+        shared = self._shared(key)
+        with self._lock:
+            entry = self._entry(key, shared)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                value, fetched_at = entry
+                fresh = time.time() - fetched_at < self.ttl
+                if not fresh and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+        if entry is not None:
+            cache_requests.inc(self.kind, 'hit' if fresh else 'stale')
+            return dict(value)
+        cache_requests.inc(self.kind, 'miss')
+        value = loader()
+        self.set(key, value)
+        return dict(value)
+
+    def peek(self, key):
+        """キャッシュ済みの値と鮮度を返す（更新はしない）"""
+        shared = self._shared(key)
+        with self._lock:
+            entry = self._entry(key, shared)
+        if entry is None:
+            cache_requests.inc(self.kind, 'miss')
+            return None, False
+        value, fetched_at = entry
+        fresh = time.time() - fetched_at < self.ttl
+        cache_requests.inc(self.kind, 'hit' if fresh else 'stale')
+        return dict(value), fresh
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, values):
+        """複数の値をまとめて保存（共有ストアへは1回で書き込む）"""
+        now = time.time()
+        changed = False
+        with self._lock:
+            for key, value in values.items():
+                previous = self._entries.get(key)
+                changed = changed or previous is None or previous[0] != value
+                self._entries[key] = (value, now)
+                self._entries.move_to_end(key)
+            self._trim()
+        if self.store is not None and values:
+            self.store.put(self.kind, {key: value['price'] for key, value in values.items()},
+                           {key: value.get('name') for key, value in values.items()}, now)
+        if self.on_change is not None and changed:
+            self.on_change()
+
+    def _refresh(self, key, loader):
+        try:
+            self.set(key, loader())
+        except Exception as e:
+            # 取得失敗時は古い値を使い続ける
+            print(f"Quote refresh error ({key}): {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+quote_cache = QuoteCache(QUOTE_CACHE_TTL, QUOTE_CACHE_MAXSIZE, store=quote_store, kind='quote')
+
+def jp_yf_symbol(code):
+    return f"{str(code).strip().upper()}.T"
+
+def us_yf_symbol(symbol):
+    return str(symbol).strip().upper()
+
+def _fetch_stock_info(yf_symbol, default_name):
+    """yfinanceから銘柄名と株価を取得（取得できない場合は例外）"""
+    with upstream_timer('yfinance', 'info'):
+        ticker = yf.Ticker(yf_symbol)
         info = ticker.info
         current_price = info.get('currentPrice', 0)
         if current_price == 0:
-            hist = ticker.history(period="1d")
+            hist = ticker.history(period="1d", timeout=UPSTREAM_READ_TIMEOUT)
             if not hist.empty:
                 current_price = hist['Close'].iloc[-1]
-        
+        if not current_price:
+            raise ValueError(f'price not found: {yf_symbol}')
         return {
-            'name': info.get('longName', f'Stock {code}'),
-            'price': round(current_price, 2) if current_price else 0
+            'name': info.get('longName', default_name),
+            'price': round(current_price, 2)
         }
+
+def _call_stock_info(yf_symbol, default_name):
+    # yfinanceのinfoはタイムアウトを指定できないので待つ時間で区切る
+    return breakers['yahoo'].call(_fetch_stock_info, yf_symbol, default_name,
+                                  timeout=UPSTREAM_CONNECT_TIMEOUT + UPSTREAM_READ_TIMEOUT,
+                                  labels=('yfinance', 'info'))
+
+def get_jp_stock_info(code):
+    """日本株の情報を取得"""
+    key = jp_yf_symbol(code)
+    try:
+        return quote_cache.get(key, lambda: _call_stock_info(key, f'Stock {code}'))
     except:
         return {'name': f'Stock {code}', 'price': 0}
 
 def get_us_stock_info(symbol):
     """米国株の情報を取得"""
+    key = us_yf_symbol(symbol)
     try:
-        ticker = yf.Ticker(symbol)
-        info = ticker.info
-        current_price = info.get('currentPrice', 0)
-        if current_price == 0:
-            hist = ticker.history(period="1d")
-            if not hist.empty:
-                current_price = hist['Close'].iloc[-1]
-        
-        return {
-            'name': info.get('longName', symbol),
-            'price': round(current_price, 2) if current_price else 0
-        }
+        return quote_cache.get(key, lambda: _call_stock_info(key, symbol))
     except:
         return {'name': symbol, 'price': 0}
 
-def get_usd_jpy_rate():
-    """USD→円レートを取得"""
-    try:
-        # yfinanceを使用してUSD/JPYレートを取得
-        ticker = yf.Ticker('USDJPY=X')
-        hist = ticker.history(period="1d")
+# --- 一括株価取得 ---
+BATCH_PRICE_CHUNK = int(os.environ.get('BATCH_PRICE_CHUNK', 200))  # 1リクエストあたりの銘柄数
+BATCH_PRICE_TTL = int(os.environ.get('BATCH_PRICE_TTL', 300))  # 秒
+BATCH_PRICE_MISS_TTL = int(os.environ.get('BATCH_PRICE_MISS_TTL', 60))  # 価格が無かった銘柄を取り直さない時間（秒）
+
+price_cache = QuoteCache(BATCH_PRICE_TTL, QUOTE_CACHE_MAXSIZE, on_change=market_changed,
+                         store=quote_store, kind='price')
+
+def _download_last_closes(symbols):
+    """複数銘柄の直近終値を1回のyfinanceリクエストで取得"""
+    with upstream_timer('yfinance', 'download'):
+        df = yf.download(symbols, period='5d', interval='1d', group_by='column',
+                         auto_adjust=False, progress=False, threads=True, timeout=UPSTREAM_READ_TIMEOUT)
+        if df is None or df.empty:
+            if YFTickerMissingError is None:
+                return {}  # 古いyfinanceでは見分けられないので従来どおりデータなしとする
+            # yfinanceは通信エラーも銘柄のデータなし（上場廃止・誤ったコード）も空で返すので、
+            # 1銘柄だけ例外を出させて見分ける。通信エラーのときだけ上流の失敗とする
+            try:
+                yf.Ticker(symbols[0]).history(period='5d', interval='1d', timeout=UPSTREAM_READ_TIMEOUT,
+                                              raise_errors=True)
+            except YFTickerMissingError:
+                return {}
+            except Exception as e:
+                raise UpstreamError(f'no prices returned for {len(symbols)} symbols: {e!r}') from e
+            return {}
+    closes = df['Close']
+    if closes.ndim == 1:
+        # 古いyfinanceでは1銘柄だとSeriesになる
+        closes = closes.to_frame(symbols[0])
+    last = closes.ffill().iloc[-1]
+    prices = {}
+    for symbol, price in last.items():
+        if price == price and price > 0:  # NaNを除外
+            prices[symbol] = round(float(price), 2)
+    return prices
+
+_price_misses = {}  # 取得しても価格が無かった銘柄 -> 次に取得してよい時刻
+
+def _record_price_misses(symbols, prices):
+    """取得しても価格が無かった銘柄を BATCH_PRICE_MISS_TTL 秒のあいだ取り直さない"""
+    now = time.time()
+    for symbol in symbols:
+        if symbol in prices:
+            _price_misses.pop(symbol, None)
+        else:
+            _price_misses[symbol] = now + BATCH_PRICE_MISS_TTL
+    for symbol, retry_at in list(_price_misses.items()):
+        if retry_at <= now:
+            _price_misses.pop(symbol, None)
+
+def _split_cached_prices(symbols):
+    """共有ストア・キャッシュにある株価と、取得し直す必要のある銘柄に分ける"""
+    prices = {}
+    missing = []
+    now = time.time()
+    stored = quote_store.snapshot('refresh', PRICE_STORE_MAX_AGE)
+    for symbol in dict.fromkeys(symbols):
+        if symbol in stored:
+            # 定期更新済みの価格を使う
+            prices[symbol] = stored[symbol]
+            cache_requests.inc('price', 'hit')
+            continue
+        cached, fresh = price_cache.peek(symbol)
+        if cached is not None:
+            prices[symbol] = cached['price']
+        if not fresh and _price_misses.get(symbol, 0) <= now:
+            missing.append(symbol)
+    return prices, missing
+
+def get_batch_prices(symbols):
+    """銘柄リストの株価をまとめて取得（symbol→price）"""
+    prices, missing = _split_cached_prices(symbols)
+    for i in range(0, len(missing), BATCH_PRICE_CHUNK):
+        chunk = missing[i:i + BATCH_PRICE_CHUNK]
+        try:
+            fetched = breakers['yahoo'].call(_download_last_closes, chunk)
+        except Exception as e:
+            print(f"Batch price fetch error: {e}")
+            continue
+        _record_price_misses(chunk, fetched)
+        price_cache.set_many({symbol: {'price': price} for symbol, price in fetched.items()})
+        prices.update(fetched)
+    return prices
+
+def fetch_prices(symbols):
+    """キャッシュを使わずに株価を一括取得（失敗時は例外）"""
+    prices = {}
+    for i in range(0, len(symbols), BATCH_PRICE_CHUNK):
+        prices.update(breakers['yahoo'].call(_download_last_closes, symbols[i:i + BATCH_PRICE_CHUNK]))
+    return prices
+
+def holding_symbols(data):
+    """保有中の日本株・米国株のyfinanceシンボル"""
+    return ({jp_yf_symbol(s['code']) for s in data.get('jp_stocks', [])} |
+            {us_yf_symbol(s['symbol']) for s in data.get('us_stocks', [])})
+
+def get_cached_prices(symbols):
+    """キャッシュ済みの株価だけを返す（期限切れでも使う）"""
+    prices = {}
+    for symbol in symbols:
+        cached, _ = price_cache.peek(symbol)
+        if cached is not None:
+            prices[symbol] = cached['price']
+    return prices
+
+def apply_prices(data, prices):
+    """取得した株価を保有銘柄に反映（取得できなかった銘柄は保存済みの価格のまま）"""
+    for stock in data.get('jp_stocks', []):
+        stock['price'] = prices.get(jp_yf_symbol(stock['code']), stock['price'])
+    for stock in data.get('us_stocks', []):
+        stock['price'] = prices.get(us_yf_symbol(stock['symbol']), stock['price'])
+    return data
+
+# --- 保有銘柄の株価の定期更新 ---
+# 全ユーザーの保有銘柄をまとめて定期的に取得し、全ワーカー共有の相場ストアに書き出す。
+# 取得するのはロックを取れた1つのワーカー（リーダー）だけで、他のワーカーはストアを読むだけ。
+PRICE_REFRESH_INTERVAL = float(os.environ.get('PRICE_REFRESH_INTERVAL', 300))  # 秒（0で無効）
+PRICE_REFRESH_JITTER = float(os.environ.get('PRICE_REFRESH_JITTER', 30))  # 秒
+PRICE_REFRESH_MAX_BACKOFF = 3600  # 取得失敗が続いたときの最大待ち時間（秒）
+PRICE_REFRESH_LOCK = os.environ.get('PRICE_REFRESH_LOCK', 'price_refresher.lock')
+PRICE_STORE_MAX_AGE = max(PRICE_REFRESH_INTERVAL * 3, BATCH_PRICE_TTL)  # これより古い価格は使わない（秒）
+
+class PriceRefresher:
+    """全ユーザーの保有銘柄の株価を定期的にまとめて取得する"""
+
+    def __init__(self, interval, jitter, lock_path):
+        self.interval = interval
+        self.jitter = jitter
+        self.lock_path = lock_path
+        self.failures = 0
+        self.last_refresh = None
+        self._symbols = {}  # user_id -> 前回読み込めた保有銘柄
+        self._lock_file = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def is_leader(self):
+        """ロックファイルを取れたワーカーがリーダー（プロセスが終わればロックは外れる）"""
+        if self._lock_file is not None:
+            return True
+        f = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._lock_file = f
+        return True
+
+    def _run(self):
+        delay = random.uniform(0, self.jitter)  # ワーカーの起動直後に重ならないようにずらす
+        while True:
+            time.sleep(delay)
+            if not self.is_leader():
+                delay = self.interval + random.uniform(0, self.jitter)
+                continue
+            try:
+                self.refresh_all()
+                self.failures = 0
+                delay = self.interval
+            except Exception as e:
+                # 失敗が続くほど間隔を空ける
+                self.failures += 1
+                delay = min(self.interval * 2 ** self.failures, PRICE_REFRESH_MAX_BACKOFF)
+                print(f"Price refresh error ({self.failures}): {e}")
+            delay += random.uniform(0, self.jitter)
+
+    def refresh_all(self):
+        """全ユーザーの保有銘柄を資産クラスごとに一括取得してストアに書き出す
+
+        資産情報を読み込めなかったユーザーは前回の保有銘柄で続ける（ログだけ出す）。
+        株価の取得に失敗した場合は取得できた分を書き出し、最後に例外にする（間隔を空ける）。
+        """
+        errors = []
+        symbols = set()
+        for user_id in USERS:
+            try:
+                self._symbols[user_id] = holding_symbols(_fetch_user_data(user_id))
+            except Exception as e:
+                # Sheetsの失敗で株価の更新まで遅らせない
+                print(f"Price refresh: cannot read {user_id}: {e}")
+            symbols |= self._symbols.get(user_id, set())
+        prices = {}
+        for group in (sorted(s for s in symbols if s.endswith('.T')), sorted(s for s in symbols if not s.endswith('.T'))):
+            try:
+                prices.update(fetch_prices(group))
+            except Exception as e:
+                errors.append(f"prices: {e!r}")
+        if prices:
+            quote_store.put('refresh', prices)
+            price_cache.set_many({symbol: {'price': price} for symbol, price in prices.items()})
+        if errors:
+            raise UpstreamError('; '.join(errors))
+        self.last_refresh = time.time()
+
+price_refresher = PriceRefresher(PRICE_REFRESH_INTERVAL, PRICE_REFRESH_JITTER, PRICE_REFRESH_LOCK)
+
+@app.before_request
+def start_price_refresher():
+    price_refresher.start()
+
+# --- 為替レート ---
+FX_REFRESH_INTERVAL = int(os.environ.get('FX_REFRESH_INTERVAL', 60))  # 秒
+FX_SYMBOL = 'USDJPY=X'
+DEFAULT_USD_JPY = 150.0  # デフォルトレート
+
+def _fetch_usd_jpy_rate():
+    """USD→円レートを外部から取得（取得できない場合は例外）"""
+    # yfinanceを使用してUSD/JPYレートを取得
+    with upstream_timer('yahoo_fx', 'history'):
+        ticker = yf.Ticker(FX_SYMBOL)
+        hist = ticker.history(period="1d", timeout=UPSTREAM_READ_TIMEOUT)
         if not hist.empty:
             return round(hist['Close'].iloc[-1], 2)
-        
-        # バックアップ: Yahoo Financeからスクレイピング
+
+    # バックアップ: Yahoo Financeからスクレイピング
+    with upstream_timer('yahoo_fx', 'scrape'):
         fx_res = requests.get('https://finance.yahoo.com/quote/USDJPY=X/', 
                              headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}, 
-                             timeout=10)
+                             timeout=UPSTREAM_TIMEOUT)
+        fx_res.raise_for_status()
         fx_html = fx_res.text
         fx_match = re.search(r'"regularMarketPrice":\{"raw":([0-9.]+)', fx_html)
         if fx_match:
             return round(float(fx_match.group(1)), 2)
-        
+
         # さらなるバックアップ
         fx_match = re.search(r'"regularMarketPrice":([0-9.]+)', fx_html)
         if fx_match:
             return round(float(fx_match.group(1)), 2)
-        
-        return 150.0  # デフォルトレート
-    except Exception as e:
-        print(f"USD/JPY rate fetch error: {e}")
-        return 150.0  # デフォルトレート
+
+        raise ValueError('USD/JPY rate not found')
+
+class FxRateService:
+    """USD/JPYレートをメモリに保持し、バックグラウンドスレッドで定期更新する
+
+    他のワーカーが interval 以内に取得したレートが共有ストアにあれば、取得せずにそれを使う。
+    """
+
+    def __init__(self, fetcher, interval, default, store=None, breaker=None):
+        self._fetcher = fetcher
+        self.breaker = breaker
+        self.interval = interval
+        self.rate = default
+        self.updated_at = None  # 最終取得時刻（epoch秒）
+        self.store = store
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """更新用のバックグラウンドスレッドを起動する（ワーカーごとに1スレッド、取得は待たない）"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def refresh(self):
+        try:
+            rate = self._fetcher() if self.breaker is None else self.breaker.call(self._fetcher)
+        except Exception as e:
+            print(f"USD/JPY rate fetch error: {e}")
+            return False
+        self.update(rate)
+        return True
+
+    def refresh_if_stale(self):
+        """共有ストアのレートが interval より古いときだけ取得する"""
+        self.adopt_shared(sync=True)
+        if self.updated_at is None or time.time() - self.updated_at >= self.interval:
+            self.refresh()
+
+    def adopt_shared(self, sync=False):
+        """他のワーカーが取得したより新しいレートがあれば使う
+
+        リクエスト中はストアを before_request で同期済みなので写しを見るだけにする。
+        リクエストの外（バックグラウンドの更新）では sync=True で読み直す。
+        """
+        if self.store is None:
+            return
+        shared = (self.store.get if sync else self.store.peek)('fx', FX_SYMBOL)
+        if shared is not None and (self.updated_at is None or shared[2] > self.updated_at):
+            self.rate, _, self.updated_at = shared
+
+    def update(self, rate):
+        self.rate = rate
+        self.updated_at = time.time()
+        if self.store is not None:
+            self.store.put('fx', {FX_SYMBOL: rate}, updated_at=self.updated_at)
+        market_changed()  # 取得時刻も表示するので値が同じでも世代を進める
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self.refresh_if_stale()
+            # 最後の取得（どのワーカーかは問わない）から interval 後に確認する（取得に失敗したときは interval 後）。
+            # 同時に起きたワーカーが揃って取得しないように少しずらす
+            age = self.age()
+            delay = self.interval - age if age is not None and age < self.interval else self.interval
+            time.sleep(delay + random.uniform(0, self.interval * 0.1))
+
+    def get(self):
+        """レートを返す（未取得なら初回の取得を待つ。呼び出し側の期限で打ち切られる）"""
+        self.start()
+        if self.updated_at is None:
+            with self._lock:
+                if self.updated_at is None:
+                    self.refresh_if_stale()
+        self.adopt_shared()
+        return self.rate
+
+    def age(self):
+        """レート取得からの経過秒数（未取得ならNone）"""
+        self.adopt_shared()
+        if self.updated_at is None:
+            return None
+        return time.time() - self.updated_at
+
+fx_service = FxRateService(_fetch_usd_jpy_rate, FX_REFRESH_INTERVAL, DEFAULT_USD_JPY, store=quote_store,
+                           breaker=breakers['yahoo_fx'])
+
+def get_usd_jpy_rate():
+    """USD→円レートを取得"""
+    return fx_service.get()
+
+def get_usd_jpy_age():
+    """USD→円レートの経過秒数を取得（初回の取得を待たず、届くまではNone）"""
+    fx_service.start()
+    age = fx_service.age()
+    return int(age) if age is not None else None
+
+# --- 金価格 ---
+GOLD_URL = "https://gold.tanaka.co.jp/commodity/souba/english/index.php"
+GOLD_PUBLISH_TIMES = ((9, 30), (14, 0))  # 田中貴金属の価格公表時刻（JST、14時は改定時のみ）
+GOLD_PUBLISH_GRACE = 300  # 公表後にページへ反映されるまでの待ち（秒）
+GOLD_RETRY_INTERVAL = 300  # 取得失敗時の再試行間隔（秒）
+_GOLD_CELL_RE = re.compile(r'<td[^>]*>\s*GOLD\s*</td>', re.IGNORECASE)
+_GOLD_PRICE_RE = re.compile(r"([0-9,]+) yen")
+
+class _GoldRowParser(HTMLParser):
+    """<tr>ごとにセルの文字列を集め、GOLD行の価格を見つけたら以降を無視するパーサ"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.price = None
+        self._cells = None
+        self._text = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.price is not None:
+            return
+        if tag == 'tr':
+            self._cells = []
+        elif tag == 'td' and self._cells is not None:
+            self._text = []
+
+    def handle_endtag(self, tag):
+        if self.price is not None:
+            return
+        if tag == 'td' and self._text is not None:
+            self._cells.append(''.join(self._text).strip())
+            self._text = None
+        elif tag == 'tr' and self._cells is not None:
+            cells = self._cells
+            self._cells = None
+            if len(cells) > 1 and cells[0].upper() == 'GOLD':
+                price_match = _GOLD_PRICE_RE.search(cells[1])
+                if price_match:
+                    self.price = int(price_match.group(1).replace(",", ""))
+
+    def handle_data(self, data):
+        if self._text is not None:
+            self._text.append(data)
+
+def _parse_gold_rows(html, chunk_size=8192):
+    """HTMLを少しずつ流し込み、GOLD行が見つかった時点で打ち切る"""
+    parser = _GoldRowParser()
+    for i in range(0, len(html), chunk_size):
+        parser.feed(html[i:i + chunk_size])
+        if parser.price is not None:
+            break
+    return parser.price
+
+def parse_gold_price(html):
+    """田中貴金属のページからGOLDの小売価格（円/g）を取り出す"""
+    # GOLDセルを含む<tr>だけを切り出して解析する
+    cell = _GOLD_CELL_RE.search(html)
+    if cell:
+        start = html.rfind('<tr', 0, cell.start())
+        end = html.find('</tr>', cell.end())
+        if start != -1 and end != -1:
+            price = _parse_gold_rows(html[start:end + len('</tr>')])
+            if price:
+                return price
+    # 構造が想定と違う場合はページ全体を解析
+    return _parse_gold_rows(html)
+
+def _fetch_gold_price():
+    """田中貴金属から金価格を取得（取得できない場合は例外）"""
+    with upstream_timer('tanaka', 'scrape'):
+        res = requests.get(GOLD_URL, headers={"User-Agent": "Mozilla/5.0"}, timeout=UPSTREAM_TIMEOUT)
+        res.raise_for_status()
+        # 必要なのはASCIIの数値だけなので文字コード判定は行わない
+        price = parse_gold_price(res.content.decode('utf-8', errors='replace'))
+        if not price:
+            raise ValueError('GOLD price not found')
+        return price
+
+def next_gold_publish_time(now):
+    """次に金価格が公表される時刻（JST、土日を除く）"""
+    now = now.astimezone(JST)
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    while True:
+        if day.weekday() < 5:
+            for hour, minute in GOLD_PUBLISH_TIMES:
+                publish = day.replace(hour=hour, minute=minute) + timedelta(seconds=GOLD_PUBLISH_GRACE)
+                if publish > now:
+                    return publish
+        day += timedelta(days=1)
+
+class GoldPriceService:
+    """金価格を次の公表時刻までキャッシュする（他のワーカーが取得した価格も使う）"""
+
+    def __init__(self, fetcher, store=None, breaker=None):
+        self._fetcher = fetcher
+        self.breaker = breaker
+        self.price = 0  # 取得できなかった場合は0
+        self.updated_at = None
+        self.expires_at = 0
+        self.store = store
+        self._lock = threading.Lock()
+
+    def get(self):
+        if time.time() < self.expires_at:
+            return self.price
+        with self._lock:
+            if time.time() < self.expires_at or self.adopt_shared():
+                return self.price
+            try:
+                self.update(self._fetcher() if self.breaker is None else self.breaker.call(self._fetcher))
+            except Exception as e:
+                print(f"Gold price fetch error: {e}")
+                self.retry_later()
+            return self.price
+
+    def update(self, price):
+        """取得した価格を次の公表時刻まで使う"""
+        if price != self.price:
+            self.price = price
+            market_changed()
+        self.updated_at = time.time()
+        self.expires_at = next_gold_publish_time(datetime.now(JST)).timestamp()
+        if self.store is not None:
+            self.store.put('gold', {'GOLD': price}, updated_at=self.updated_at)
+
+    def adopt_shared(self):
+        """他のワーカーが直近の公表時刻より後に取得した価格があれば使う（ストアは before_request で同期済み）"""
+        if self.store is None:
+            return False
+        shared = self.store.peek('gold', 'GOLD')
+        if shared is None or (self.updated_at is not None and shared[2] <= self.updated_at):
+            return False
+        price, _, updated_at = shared
+        expires_at = next_gold_publish_time(datetime.fromtimestamp(updated_at, JST)).timestamp()
+        if time.time() >= expires_at:
+            return False
+        self.price, self.updated_at, self.expires_at = price, updated_at, expires_at
+        return True
+
+    def retry_later(self):
+        """前回の価格を使い続け、少し待ってから再取得"""
+        self.expires_at = time.time() + GOLD_RETRY_INTERVAL
+
+gold_service = GoldPriceService(_fetch_gold_price, store=quote_store, breaker=breakers['tanaka'])
 
 def get_gold_price():
     """金価格を取得"""
+    return gold_service.get()
+
+# --- 外部取得の並列実行 ---
+FETCH_POOL_SIZE = int(os.environ.get('FETCH_POOL_SIZE', 8))
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 3.0))  # 1リクエストあたりの待ち時間上限（秒）
+
+fetch_pool = ThreadPoolExecutor(max_workers=FETCH_POOL_SIZE, thread_name_prefix='fetch')
+
+def fetch_concurrently(calls, deadline=REQUEST_DEADLINE):
+    """独立した外部取得を共有スレッドプールで並列実行する
+
+    calls は {name: (取得関数, 前回値を返す関数)}。期限までに終わらなかったものや
+    失敗したものは前回値を使う（実行中の取得はそのまま続き、キャッシュを更新する）。
+    """
+    futures = {name: fetch_pool.submit(func) for name, (func, _) in calls.items()}
+    done, _ = wait(futures.values(), timeout=deadline)
+    results = {}
+    for name, future in futures.items():
+        if future in done and future.exception() is None:
+            results[name] = future.result()
+        else:
+            results[name] = calls[name][1]()
+    return results
+
+def fetch_market_data(data, fx=False, gold=False, deadline=REQUEST_DEADLINE):
+    """保有銘柄の株価（資産クラスごとに一括）と為替・金価格をまとめて取得"""
+    jp_symbols = [jp_yf_symbol(s['code']) for s in data.get('jp_stocks', [])]
+    us_symbols = [us_yf_symbol(s['symbol']) for s in data.get('us_stocks', [])]
+    calls = {}
+    if jp_symbols:
+        calls['jp_prices'] = (lambda: get_batch_prices(jp_symbols), lambda: get_cached_prices(jp_symbols))
+    if us_symbols:
+        calls['us_prices'] = (lambda: get_batch_prices(us_symbols), lambda: get_cached_prices(us_symbols))
+    if fx:
+        calls['usd_jpy'] = (get_usd_jpy_rate, lambda: fx_service.rate)
+    if gold:
+        calls['gold_price'] = (get_gold_price, lambda: gold_service.price)
+    results = fetch_concurrently(calls, deadline)
+    prices = results.pop('jp_prices', {})
+    prices.update(results.pop('us_prices', {}))
+    results['prices'] = prices
+    return results
+
+def get_portfolio_prices(data):
+    """保有中の日本株・米国株の株価を資産クラスごとに一括取得"""
+    return fetch_market_data(data)['prices']
+
+# --- 価格のリアルタイム配信（SSE） ---
+# gunicornは gthread ワーカーで動かし、購読数はスレッド数より少なく抑える（Procfile参照）
+STREAM_REFRESH_INTERVAL = float(os.environ.get('STREAM_REFRESH_INTERVAL', 15))  # 相場の確認間隔（秒）
+STREAM_HEARTBEAT = 15  # 接続維持用のコメント送信間隔（秒）
+SSE_MAX_SUBSCRIBERS = int(os.environ.get('SSE_MAX_SUBSCRIBERS', 16))  # ワーカーあたりの購読上限
+
+class PriceStream:
+    """相場を1か所でまとめて確認し、変わった値だけを全購読者へ配る"""
+
+    def __init__(self, interval, max_subscribers):
+        self.interval = interval
+        self.max_subscribers = max_subscribers
+        self._subscribers = {}  # queue -> (user_id, symbols)
+        self._last = {'usd_jpy': None, 'gold': None, 'prices': {}}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id, symbols):
+        """購読を登録（上限に達していればNone）"""
+        events = queue.Queue(maxsize=100)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers[events] = (user_id, set(symbols))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return events
+
+    def unsubscribe(self, events):
+        with self._lock:
+            self._subscribers.pop(events, None)
+
+    def update_symbols(self, user_id, symbols):
+        """保有銘柄が変わったユーザーの購読対象を差し替える"""
+        with self._lock:
+            for events, (subscriber, _) in self._subscribers.items():
+                if subscriber == user_id:
+                    self._subscribers[events] = (user_id, set(symbols))
+
+    def current(self, symbols):
+        """最後に配信した値（接続直後の初期値）"""
+        with self._lock:
+            prices = {s: p for s, p in self._last['prices'].items() if s in symbols}
+            return {'usd_jpy': self._last['usd_jpy'], 'gold': self._last['gold'], 'prices': prices}
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Price stream refresh error: {e}")
+            time.sleep(self.interval)
+
+    def refresh(self):
+        """相場を取得して前回から変わった分だけを配信"""
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        if not subscribers:
+            return
+        symbols = set().union(*(s for _, (_, s) in subscribers))
+        prices = get_batch_prices(sorted(s for s in symbols if s.endswith('.T')))
+        prices.update(get_batch_prices(sorted(s for s in symbols if not s.endswith('.T'))))
+        usd_jpy = fx_service.get()
+        gold = get_gold_price()
+
+        delta = {}
+        with self._lock:
+            if usd_jpy != self._last['usd_jpy']:
+                delta['usd_jpy'] = self._last['usd_jpy'] = usd_jpy
+            if gold != self._last['gold']:
+                delta['gold'] = self._last['gold'] = gold
+            changed = {s: p for s, p in prices.items() if self._last['prices'].get(s) != p}
+            self._last['prices'].update(changed)
+        for events, (_, subscriber_symbols) in subscribers:
+            event = dict(delta)
+            own = {s: p for s, p in changed.items() if s in subscriber_symbols}
+            if own:
+                event['prices'] = own
+            if 'usd_jpy' in event:
+                event['usd_jpy_age'] = get_usd_jpy_age()
+            if event:
+                try:
+                    events.put_nowait(event)
+                except queue.Full:
+                    pass  # 受け取れていない購読者には送らない
+
+price_stream = PriceStream(STREAM_REFRESH_INTERVAL, SSE_MAX_SUBSCRIBERS)
+
+# --- 条件付きGET（ETag） ---
+def document_etag(data, market=None):
+    """ユーザーの資産情報の版数と、評価に使った相場から強いETagを作る
+
+    相場はキャッシュの世代ではなく実際に使った値を含める（バックグラウンド更新と競合しても本文とずれない）。
+    """
+    parts = [request.endpoint, current_user.id, data.get('revision') or data.get('last_updated')]
+    if market is not None:
+        parts.append([market.get('usd_jpy'), market.get('gold_price'), sorted(market.get('prices', {}).items())])
+    return hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+
+def conditional_json(etag, build):
+    """If-None-Matchが一致すれば本文を作らずに304を返す"""
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        body = build()
+        if isinstance(body, str):
+            # シリアライズ済み（描画結果のキャッシュから）
+            response = app.response_class(body, mimetype='application/json')
+        else:
+            response = jsonify(body)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# --- 評価額の計算 ---
+# 行を表示する資産クラス -> (数量の項目, 価格の項目, 通貨)
+PORTFOLIO_CLASSES = {
+    'jp_stocks': ('qty', 'price', 'JPY'),
+    'us_stocks': ('qty', 'price', 'USD'),
+    'funds': ('qty', 'price', 'JPY'),
+}
+
+class AssetValues:
+    """1つの資産クラスの行ごとの評価額（現地通貨と円）"""
+
+    __slots__ = ('items', 'value', 'value_jpy')
+
+    def __init__(self, items, qty_field, price_field, rate):
+        self.items = items
+        self.value = [item[qty_field] * item[price_field] for item in items]
+        self.value_jpy = self.value if rate == 1.0 else [value * rate for value in self.value]
+
+    def rows(self):
+        """(保有, 評価額, 円換算の評価額) をテンプレート向けに返す"""
+        return zip(self.items, self.value, self.value_jpy)
+
+class Portfolio:
+    """ユーザーの保有と相場をまとめ、評価額をHTMLのページとJSONのAPIで共有する
+
+    合計は compute_totals で1回だけ計算する。行ごとの評価額は、その資産クラスの行を
+    表示するときに初めて計算する。
+    """
+
+    def __init__(self, data, usd_jpy, gold_price):
+        self.data = data
+        self.usd_jpy = usd_jpy
+        self.gold_price = gold_price
+        self.rates = {'JPY': 1.0, 'USD': usd_jpy or 0}
+        self.classes = {}
+        self._totals = None
+
+    def __getitem__(self, asset):
+        values = self.classes.get(asset)
+        if values is None:
+            qty_field, price_field, currency = PORTFOLIO_CLASSES[asset]
+            values = self.classes[asset] = AssetValues(self.data.get(asset, []), qty_field, price_field,
+                                                       self.rates[currency])
+        return values
+
+    def totals(self):
+        """資産クラスごとの評価額（円、米国株はドル建ても）"""
+        if self._totals is None:
+            self._totals = compute_totals(self.data, self.usd_jpy, self.gold_price)
+        return dict(self._totals)
+
+def compute_totals(data, usd_jpy, gold_price):
+    """資産クラスごとの評価額を計算"""
+    jp_total = sum(stock['qty'] * stock['price'] for stock in data.get('jp_stocks', []))
+    us_total_usd = sum(stock['qty'] * stock['price'] for stock in data.get('us_stocks', []))
+    us_total_jpy = int(us_total_usd * usd_jpy) if usd_jpy else 0
+    fund_total = sum(fund['qty'] * fund['price'] for fund in data.get('funds', []))
+    gold_total = (data.get('gold_qty') or 0) * gold_price
+    cash_total = sum(item['amount'] for item in data.get('cash_items', []))
+    return {
+        'jp_total': jp_total,
+        'us_total_usd': us_total_usd,
+        'us_total_jpy': us_total_jpy,
+        'fund_total': fund_total,
+        'gold_total': gold_total,
+        'cash_total': cash_total,
+        'grand_total': jp_total + us_total_jpy + fund_total + gold_total + cash_total,
+    }
+
+def dashboard_payload(data, market, portfolio=None):
+    """/api/dashboard のレスポンス"""
+    if portfolio is None:
+        portfolio = Portfolio(data, market['usd_jpy'], market['gold_price'])
+    payload = portfolio.totals()
+    payload.update({
+        'usd_jpy': market['usd_jpy'],
+        'usd_jpy_age': get_usd_jpy_age(),
+        'last_updated': data.get('last_updated')
+    })
+    return payload
+
+# --- 評価額の履歴 ---
+# {user}_history シートに1日1行（JSTの日付）で資産クラスごとの評価額（円）を記録する。
+HISTORY_COLUMNS = ['date', 'jp_stocks', 'us_stocks', 'funds', 'gold', 'cash', 'total', 'usd_jpy']
+HISTORY_SNAPSHOT = os.environ.get('HISTORY_SNAPSHOT', '1') == '1'
+HISTORY_SNAPSHOT_TIME = os.environ.get('HISTORY_SNAPSHOT_TIME', '16:00')  # 記録時刻（JST、東証の大引け後）
+HISTORY_CACHE_TTL = float(os.environ.get('HISTORY_CACHE_TTL', 600))  # 秒
+HISTORY_RANGES = {'1m': 31, '3m': 92, '6m': 183, '1y': 366, '5y': 1827, 'all': None}  # 期間 -> 日数
+TROY_OUNCE_GRAMS = 31.1034768
+
+_history_cache = {}  # user_id -> (rows, cached_at)
+_history_lock = threading.Lock()
+
+def _history_sheet_name(user_id):
+    return f"{user_id}_history"
+
+def _read_history(user_id):
+    """履歴シートを読み込み（日付順の行のリスト）"""
+    sheet_name = _history_sheet_name(user_id)
     try:
-        tanaka_url = "https://gold.tanaka.co.jp/commodity/souba/english/index.php"
-        res = requests.get(tanaka_url, headers={"User-Agent": "Mozilla/5.0"}, timeout=10)
-        res.encoding = res.apparent_encoding
-        soup = BeautifulSoup(res.text, "html.parser")
-        
-        for tr in soup.find_all("tr"):
-            tds = tr.find_all("td")
-            if len(tds) > 1 and tds[0].get_text(strip=True).upper() == "GOLD":
-                price_text = tds[1].get_text(strip=True)
-                price_match = re.search(r"([0-9,]+) yen", price_text)
-                if price_match:
-                    return int(price_match.group(1).replace(",", ""))
-        return 0  # 取得できなかった場合は0を返す
-    except:
+        with upstream_timer('sheets', 'read_history'):
+            values = sheets_pool.worksheet(sheet_name).get_all_values()
+    except gspread.exceptions.WorksheetNotFound:
+        return []
+    except Exception as e:
+        _handle_sheets_error(sheet_name, e)
+        raise
+    rows = []
+    for values_row in values[1:]:
+        row = dict(zip(HISTORY_COLUMNS, values_row))
+        if not row.get('date'):
+            continue
+        for column in HISTORY_COLUMNS[1:]:
+            try:
+                row[column] = float(row.get(column) or 0) if column == 'usd_jpy' else int(float(row.get(column) or 0))
+            except ValueError:
+                row[column] = 0
+        rows.append(row)
+    rows.sort(key=lambda row: row['date'])
+    return rows
+
+def load_history(user_id):
+    """評価額の履歴（HISTORY_CACHE_TTL秒はメモリ上の結果を使う）"""
+    with _history_lock:
+        entry = _history_cache.get(user_id)
+    if entry is not None and time.time() - entry[1] < HISTORY_CACHE_TTL:
+        return entry[0]
+    rows = _read_history(user_id)
+    with _history_lock:
+        _history_cache[user_id] = (rows, time.time())
+    return rows
+
+def save_history_rows(user_id, rows, overwrite=True):
+    """日付ごとに履歴へ反映して保存（overwrite=Falseなら記録済みの日は残す）。追加・更新した日数を返す"""
+    sheet_name = _history_sheet_name(user_id)
+    merged = {row['date']: row for row in _read_history(user_id)}
+    changed = 0
+    for row in rows:
+        if overwrite or row['date'] not in merged:
+            merged[row['date']] = row
+            changed += 1
+    if not changed:
         return 0
+    values = [HISTORY_COLUMNS] + [[merged[date][column] for column in HISTORY_COLUMNS] for date in sorted(merged)]
+    try:
+        with upstream_timer('sheets', 'write_history'):
+            ws = sheets_pool.worksheet(sheet_name, create=True)
+            if ws.row_count < len(values) or ws.col_count < len(HISTORY_COLUMNS):
+                ws.resize(rows=max(ws.row_count, len(values)), cols=max(ws.col_count, len(HISTORY_COLUMNS)))
+            ws.update(range_name='A1', values=values)
+    except Exception as e:
+        _handle_sheets_error(sheet_name, e)
+        raise
+    with _history_lock:
+        _history_cache.pop(user_id, None)
+    return changed
+
+def history_row(date, totals, usd_jpy):
+    return {
+        'date': date,
+        'jp_stocks': round(totals['jp_total']),
+        'us_stocks': round(totals['us_total_jpy']),
+        'funds': round(totals['fund_total']),
+        'gold': round(totals['gold_total']),
+        'cash': round(totals['cash_total']),
+        'total': round(totals['grand_total']),
+        'usd_jpy': round(float(usd_jpy), 2),
+    }
+
+def record_history_snapshot(user_id):
+    """現在の評価額を今日（JST）の履歴として記録"""
+    data = _load_user_data(user_id)
+    market = fetch_market_data(data, fx=True, gold=True, deadline=60)
+    apply_prices(data, market['prices'])
+    totals = compute_totals(data, market['usd_jpy'], market['gold_price'])
+    row = history_row(datetime.now(JST).strftime('%Y-%m-%d'), totals, market['usd_jpy'])
+    save_history_rows(user_id, [row])
+    return row
+
+def _download_closes(symbols, start):
+    """複数銘柄の日次終値（日付×銘柄）を1回のyfinanceリクエストで取得"""
+    with upstream_timer('yfinance', 'download'):
+        df = yf.download(symbols, start=start, interval='1d', group_by='column',
+                         auto_adjust=False, progress=False, threads=True, timeout=UPSTREAM_READ_TIMEOUT)
+    if df is None or df.empty:
+        return pd.DataFrame(columns=symbols, index=pd.DatetimeIndex([]), dtype=float)
+    closes = df['Close']
+    if closes.ndim == 1:
+        closes = closes.to_frame(symbols[0])
+    closes.index = pd.DatetimeIndex(closes.index).tz_localize(None).normalize()
+    return closes
+
+def _holding_vectors(stocks, symbol_of):
+    """保有銘柄を銘柄ごとにまとめ、(シンボル, 数量の配列, 保存済み価格) にする"""
+    qty, price = {}, {}
+    for stock in stocks:
+        symbol = symbol_of(stock)
+        qty[symbol] = qty.get(symbol, 0) + stock['qty']
+        price[symbol] = stock['price']
+    symbols = sorted(qty)
+    return symbols, np.array([qty[s] for s in symbols], dtype=float), price
+
+def _position_values(closes, index, symbols, qty, fallback):
+    """日付ごとの 数量×終値 の合計（日付・銘柄のループなしで行列積で計算）"""
+    if not symbols:
+        return np.zeros(len(index))
+    # 休場日は直前の終値、取得できない期間は保存済みの価格で埋める
+    matrix = closes.reindex(index=index, columns=symbols).ffill().fillna(fallback)
+    return matrix.to_numpy(dtype=float) @ qty
+
+def build_history_frame(data, start, usd_jpy, gold_price):
+    """現在の保有数量で start 以降の日次評価額を推計する
+
+    株価・為替・金先物（GC=F）は資産クラスごとに1回ずつ一括取得する。
+    投資信託と現金は過去の価格がないため現在の評価額で一定とし、
+    金は現在の田中貴金属の価格を金先物×為替の推移で過去に引き延ばす。
+    """
+    jp_symbols, jp_qty, jp_price = _holding_vectors(data.get('jp_stocks', []), lambda s: jp_yf_symbol(s['code']))
+    us_symbols, us_qty, us_price = _holding_vectors(data.get('us_stocks', []), lambda s: us_yf_symbol(s['symbol']))
+    no_closes = pd.DataFrame(index=pd.DatetimeIndex([]))
+    jp_closes = _download_closes(jp_symbols, start) if jp_symbols else no_closes
+    us_closes = _download_closes(us_symbols, start) if us_symbols else no_closes
+    market = _download_closes(['USDJPY=X', 'GC=F'], start)
+    index = jp_closes.index.union(us_closes.index).union(market.index)
+    if len(index) == 0:
+        return pd.DataFrame(columns=HISTORY_COLUMNS[1:])
+    market = market.reindex(index=index, columns=['USDJPY=X', 'GC=F']).ffill().bfill()
+    fx = market['USDJPY=X'].fillna(usd_jpy).to_numpy(dtype=float)
+    gold_jpy = market['GC=F'].to_numpy(dtype=float) * fx
+    gold_ratio = np.nan_to_num(gold_jpy / gold_jpy[-1], nan=1.0)
+    frame = pd.DataFrame({
+        'jp_stocks': _position_values(jp_closes, index, jp_symbols, jp_qty, jp_price),
+        'us_stocks': _position_values(us_closes, index, us_symbols, us_qty, us_price) * fx,
+        'funds': sum(f['qty'] * f['price'] for f in data.get('funds', [])),
+        'gold': (data.get('gold_qty') or 0) * gold_price * gold_ratio,
+        'cash': sum(item['amount'] for item in data.get('cash_items', [])),
+    }, index=index)
+    frame['total'] = frame.sum(axis=1)
+    frame = frame.round()
+    frame['usd_jpy'] = fx.round(2)
+    return frame
+
+def backfill_history(user_id, start):
+    """過去の評価額を推計し、履歴の記録がない日を埋める（埋めた日数を返す）"""
+    data = _load_user_data(user_id)
+    frame = build_history_frame(data, start, get_usd_jpy_rate(), get_gold_price())
+    rows = [dict(row, date=date.strftime('%Y-%m-%d'))
+            for date, row in zip(frame.index, frame.astype({c: 'int64' for c in HISTORY_COLUMNS[1:-1]}).to_dict('records'))]
+    return save_history_rows(user_id, rows, overwrite=False)
+
+@app.cli.command('backfill-history')
+@click.option('--days', default=365, help='遡る日数')
+def backfill_history_command(days):
+    """全ユーザーの現在の保有銘柄から過去の評価額を推計して履歴を埋める"""
+    start = (datetime.now(JST) - timedelta(days=days)).strftime('%Y-%m-%d')
+    for user_id in USERS:
+        print(f"{user_id}: {backfill_history(user_id, start)} days")
+
+def next_history_snapshot_time(now):
+    """次に履歴を記録する時刻（JST、土日を除く）"""
+    hour, minute = (int(part) for part in HISTORY_SNAPSHOT_TIME.split(':'))
+    now = now.astimezone(JST)
+    snapshot = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    while snapshot <= now or snapshot.weekday() >= 5:
+        snapshot += timedelta(days=1)
+    return snapshot
+
+class HistoryRecorder:
+    """営業日の記録時刻に全ユーザーの評価額を履歴に記録する（株価の定期更新と同じリーダーのワーカーだけ）"""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.last_snapshot = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        if self._thread is not None or not self.enabled:
+            return
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(max(next_history_snapshot_time(datetime.now(JST)).timestamp() - time.time(), 0))
+            if not price_refresher.is_leader():
+                continue
+            for user_id in USERS:
+                try:
+                    record_history_snapshot(user_id)
+                except Exception as e:
+                    print(f"History snapshot error ({user_id}): {e}")
+            self.last_snapshot = time.time()
+
+history_recorder = HistoryRecorder(HISTORY_SNAPSHOT)
+
+@app.before_request
+def start_history_recorder():
+    history_recorder.start()
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -202,160 +2396,32 @@ def logout():
 def dashboard():
     """メインダッシュボード"""
     data = load_data()
+    return cached_fragment(data, 'dashboard', lambda: render_dashboard(data))
+
+def dashboard_portfolio(data):
+    """相場を反映したPortfolio（HTMLとJSONのダッシュボードで共有し、描画結果と同じキーで再利用する）"""
+    def build():
+        market = fetch_market_data(data, fx=True, gold=True)
+        apply_prices(data, market['prices'])
+        return market, Portfolio(data, market['usd_jpy'], market['gold_price'])
+    return cached_fragment(data, 'portfolio', build)
+
+def render_dashboard(data):
+    """ダッシュボードのHTMLを描画"""
+    market, portfolio = dashboard_portfolio(data)
+    usd_jpy = market['usd_jpy']
+    usd_jpy_age = get_usd_jpy_age()
     # 各資産の評価額を計算
-    jp_total = sum(stock['qty'] * stock['price'] for stock in data['jp_stocks'])
-    usd_jpy = get_usd_jpy_rate()
-    us_total_usd = sum(stock['qty'] * stock['price'] for stock in data['us_stocks'])
-    us_total_jpy = int(us_total_usd * usd_jpy) if usd_jpy else 0
-    fund_total = sum(fund['qty'] * fund['price'] for fund in data['funds'])
-    crypto_total = 0  # 仮想通貨は後で実装
-    gold_price = get_gold_price()
-    gold_total = (data.get('gold_qty') or 0) * gold_price
-    cash_total = sum(item['amount'] for item in data.get('cash_items', []))
-    template = """
-    <!DOCTYPE html>
-    <html lang=\"ja">
-    <head>
-        <meta charset=\"UTF-8">
-        <meta name=\"viewport\" content=\"width=device-width, initial-scale=1.0">
-        <title>資産情報ダッシュボード</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 20px; }
-            table { border-collapse: collapse; width: 100%; margin: 20px 0; }
-            th, td { border: 1px solid #ddd; padding: 8px; text-align: center; }
-            th { background-color: #f2f2f2; }
-            .asset-link { color: #0066cc; text-decoration: none; }
-            .asset-link:hover { text-decoration: underline; }
-            .nav-links { margin: 20px 0; }
-            .nav-links a { margin-right: 15px; padding: 5px 10px; background: #0066cc; color: white; text-decoration: none; border-radius: 3px; }
-            .nav-links a:hover { background: #0052a3; }
-            .total { font-weight: bold; background-color: #e8f4fd; }
-            .rate-info { margin: 10px 0; font-size: 14px; color: #666; }
-        </style>
-    </head>
-    <body>
-        <h1>資産情報ダッシュボード</h1>
-        <div class=\"rate-info\">
-            USD/JPY レート: {{ "{:.2f}".format(usd_jpy) }} 円
-        </div>
-        <div class=\"nav-links\">
-            <a href=\"{{ url_for('jp_stocks') }}\">日本株管理</a>
-            <a href=\"{{ url_for('us_stocks') }}\">米国株管理</a>
-            <a href=\"{{ url_for('funds') }}\">投資信託管理</a>
-            <a href=\"{{ url_for('gold') }}\">金管理</a>
-            <a href=\"{{ url_for('cash') }}\">現金管理</a>
-        </div>
-        <table>
-            <tr>
-                <th>資産</th>
-                <th>評価額</th>
-            </tr>
-            <tr>
-                <td><a href=\"{{ url_for('jp_stocks') }}\" class=\"asset-link\">日本株</a></td>
-                <td>{{ "{:,}".format(jp_total|int) }} 円</td>
-            </tr>
-            <tr>
-                <td><a href=\"{{ url_for('us_stocks') }}\" class=\"asset-link\">米国株</a></td>
-                <td>{{ "{:,}".format(us_total_jpy|int) }} 円（${{ "{:.2f}".format(us_total_usd) }}）</td>
-            </tr>
-            <tr>
-                <td><a href=\"{{ url_for('funds') }}\" class=\"asset-link\">投資信託</a></td>
-                <td>{{ "{:,}".format(fund_total|int) }} 円</td>
-            </tr>
-            <tr>
-                <td>仮想通貨</td>
-                <td>0 USD</td>
-            </tr>
-            <tr>
-                <td><a href=\"{{ url_for('gold') }}\" class=\"asset-link\">金 (Gold)</a></td>
-                <td>{{ "{:,}".format(gold_total|int) }} 円</td>
-            </tr>
-            <tr>
-                <td><a href=\"{{ url_for('cash') }}\" class=\"asset-link\">現金</a></td>
-                <td>{{ "{:,}".format(cash_total|int) }} 円</td>
-            </tr>
-            <tr class=\"total\">
-                <td>合計</td>
-                <td>{{ "{:,}".format((jp_total + fund_total + gold_total + us_total_jpy + cash_total)|int) }} 円</td>
-            </tr>
-        </table>
-        {% if data.last_updated %}
-        <p><small>最終更新: {{ data.last_updated }}</small></p>
-        {% endif %}
-    </body>
-    </html>
-    """
-    return render_template_string(template, jp_total=jp_total, us_total_usd=us_total_usd, us_total_jpy=us_total_jpy, fund_total=fund_total, gold_total=gold_total, data=data, usd_jpy=usd_jpy, cash_total=cash_total)
+    totals = portfolio.totals()
+    return render_template('dashboard.html', data=data, usd_jpy=usd_jpy, usd_jpy_age=usd_jpy_age, **totals)
 
 @app.route('/jp_stocks')
 def jp_stocks():
     """日本株管理ページ"""
     data = load_data()
-    
-    template = """
-    <!DOCTYPE html>
-    <html lang="ja">
-    <head>
-        <meta charset="UTF-8">
-        <title>日本株ダッシュボード</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 20px; }
-            table { border-collapse: collapse; width: 100%; margin: 20px 0; }
-            th, td { border: 1px solid #ddd; padding: 8px; text-align: center; }
-            th { background-color: #f2f2f2; }
-            .form-group { margin: 10px 0; }
-            input[type="text"], input[type="number"] { padding: 5px; margin: 5px; }
-            button { padding: 8px 15px; background: #0066cc; color: white; border: none; border-radius: 3px; cursor: pointer; }
-            button:hover { background: #0052a3; }
-            .back-link { margin: 20px 0; }
-            .back-link a { color: #0066cc; text-decoration: none; }
-            .delete-btn { background: #dc3545; padding: 4px 8px; font-size: 12px; }
-            .delete-btn:hover { background: #c82333; }
-        </style>
-    </head>
-    <body>
-        <div class="back-link"><a href="{{ url_for('dashboard') }}">← ダッシュボードに戻る</a></div>
-        
-        <h1>日本株ダッシュボード</h1>
-        
-        <form method="POST" action="{{ url_for('add_jp_stock') }}">
-            <div class="form-group">
-                <input type="text" name="code" placeholder="証券コード" required>
-                <input type="number" name="qty" step="1" placeholder="数量" required>
-                <button type="submit">追加</button>
-            </div>
-        </form>
-        
-        <table>
-            <tr>
-                <th>会社名</th>
-                <th>証券コード</th>
-                <th>数量</th>
-                <th>株価</th>
-                <th>評価額</th>
-                <th>操作</th>
-            </tr>
-            {% for stock in data.jp_stocks %}
-            <tr>
-                <td>{{ stock.name }}</td>
-                <td>{{ stock.code }}</td>
-                <td>{{ stock.qty }}</td>
-                <td>{{ "{:,.2f}".format(stock.price) }} 円</td>
-                <td>{{ "{:,}".format((stock.qty * stock.price)|int) }} 円</td>
-                <td>
-                    <form method="POST" action="{{ url_for('delete_jp_stock') }}" style="display: inline;">
-                        <input type="hidden" name="code" value="{{ stock.code }}">
-                        <button type="submit" class="delete-btn" onclick="return confirm('削除しますか？')">削除</button>
-                    </form>
-                </td>
-            </tr>
-            {% endfor %}
-        </table>
-    </body>
-    </html>
-    """
-    
-    return render_template_string(template, data=data)
+    apply_prices(data, get_portfolio_prices(data))
+    portfolio = Portfolio(data, None, 0)
+    return render_template('jp_stocks.html', data=data, portfolio=portfolio)
 
 @app.route('/add_jp_stock', methods=['POST'])
 def add_jp_stock():
@@ -367,19 +2433,12 @@ def add_jp_stock():
     stock_info = get_jp_stock_info(code)
     
     # 既存の株式を更新するか新規追加
-    for stock in data['jp_stocks']:
-        if stock['code'] == code:
-            stock['qty'] = qty
-            stock['price'] = stock_info['price']
-            stock['name'] = stock_info['name']
-            break
-    else:
-        data['jp_stocks'].append({
-            'code': code,
-            'name': stock_info['name'],
-            'qty': qty,
-            'price': stock_info['price']
-        })
+    holdings(data, 'jp_stocks').upsert({
+        'code': code,
+        'name': stock_info['name'],
+        'qty': qty,
+        'price': stock_info['price']
+    })
     
     save_data(data)
     return redirect(url_for('jp_stocks'))
@@ -389,7 +2448,7 @@ def delete_jp_stock():
     """日本株を削除"""
     data = load_data()
     code = request.form['code']
-    data['jp_stocks'] = [stock for stock in data['jp_stocks'] if stock['code'] != code]
+    holdings(data, 'jp_stocks').delete(code)
     save_data(data)
     return redirect(url_for('jp_stocks'))
 
@@ -397,81 +2456,12 @@ def delete_jp_stock():
 def us_stocks():
     """米国株管理ページ"""
     data = load_data()
-    usd_jpy = get_usd_jpy_rate()
-    
-    template = """
-    <!DOCTYPE html>
-    <html lang="ja">
-    <head>
-        <meta charset="UTF-8">
-        <title>米国株ダッシュボード</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 20px; }
-            table { border-collapse: collapse; width: 100%; margin: 20px 0; }
-            th, td { border: 1px solid #ddd; padding: 8px; text-align: center; }
-            th { background-color: #f2f2f2; }
-            .form-group { margin: 10px 0; }
-            input[type="text"], input[type="number"] { padding: 5px; margin: 5px; }
-            button { padding: 8px 15px; background: #0066cc; color: white; border: none; border-radius: 3px; cursor: pointer; }
-            button:hover { background: #0052a3; }
-            .back-link { margin: 20px 0; }
-            .back-link a { color: #0066cc; text-decoration: none; }
-            .delete-btn { background: #dc3545; padding: 4px 8px; font-size: 12px; }
-            .delete-btn:hover { background: #c82333; }
-            .rate-info { margin: 10px 0; font-size: 14px; color: #666; }
-        </style>
-    </head>
-    <body>
-        <div class="back-link"><a href="{{ url_for('dashboard') }}">← ダッシュボードに戻る</a></div>
-        
-        <h1>米国株ダッシュボード</h1>
-        
-        <div class="rate-info">
-            USD/JPY レート: {{ "{:,.2f}".format(usd_jpy) }} 円
-        </div>
-        
-        <form method="POST" action="{{ url_for('add_us_stock') }}">
-            <div class="form-group">
-                <input type="text" name="symbol" placeholder="ティッカーシンボル" required>
-                <input type="number" name="qty" step="0.01" placeholder="数量" required>
-                <button type="submit">追加</button>
-            </div>
-        </form>
-        
-        <table>
-            <tr>
-                <th>会社名</th>
-                <th>シンボル</th>
-                <th>数量</th>
-                <th>株価(USD)</th>
-                <th>株価(JPY)</th>
-                <th>評価額(USD)</th>
-                <th>評価額(JPY)</th>
-                <th>操作</th>
-            </tr>
-            {% for stock in data.us_stocks %}
-            <tr>
-                <td>{{ stock.name }}</td>
-                <td>{{ stock.symbol }}</td>
-                <td>{{ stock.qty }}</td>
-                <td>${{ "{:,.2f}".format(stock.price) }}</td>
-                <td>{{ "{:,.0f}".format(stock.price * usd_jpy) }} 円</td>
-                <td>${{ "{:,.2f}".format(stock.qty * stock.price) }}</td>
-                <td>{{ "{:,}".format((stock.qty * stock.price * usd_jpy)|int) }} 円</td>
-                <td>
-                    <form method="POST" action="{{ url_for('delete_us_stock') }}" style="display: inline;">
-                        <input type="hidden" name="symbol" value="{{ stock.symbol }}">
-                        <button type="submit" class="delete-btn" onclick="return confirm('削除しますか？')">削除</button>
-                    </form>
-                </td>
-            </tr>
-            {% endfor %}
-        </table>
-    </body>
-    </html>
-    """
-    
-    return render_template_string(template, data=data, usd_jpy=usd_jpy)
+    market = fetch_market_data(data, fx=True)
+    apply_prices(data, market['prices'])
+    usd_jpy = market['usd_jpy']
+    usd_jpy_age = get_usd_jpy_age()
+    portfolio = Portfolio(data, usd_jpy, 0)
+    return render_template('us_stocks.html', data=data, usd_jpy=usd_jpy, usd_jpy_age=usd_jpy_age, portfolio=portfolio)
 
 @app.route('/add_us_stock', methods=['POST'])
 def add_us_stock():
@@ -483,19 +2473,12 @@ def add_us_stock():
     stock_info = get_us_stock_info(symbol)
     
     # 既存の株式を更新するか新規追加
-    for stock in data['us_stocks']:
-        if stock['symbol'] == symbol:
-            stock['qty'] = qty
-            stock['price'] = stock_info['price']
-            stock['name'] = stock_info['name']
-            break
-    else:
-        data['us_stocks'].append({
-            'symbol': symbol,
-            'name': stock_info['name'],
-            'qty': qty,
-            'price': stock_info['price']
-        })
+    holdings(data, 'us_stocks').upsert({
+        'symbol': symbol,
+        'name': stock_info['name'],
+        'qty': qty,
+        'price': stock_info['price']
+    })
     
     save_data(data)
     return redirect(url_for('us_stocks'))
@@ -505,7 +2488,7 @@ def delete_us_stock():
     """米国株を削除"""
     data = load_data()
     symbol = request.form['symbol']
-    data['us_stocks'] = [stock for stock in data['us_stocks'] if stock['symbol'] != symbol]
+    holdings(data, 'us_stocks').delete(symbol)
     save_data(data)
     return redirect(url_for('us_stocks'))
 
@@ -513,70 +2496,8 @@ def delete_us_stock():
 def funds():
     """投資信託管理ページ"""
     data = load_data()
-    
-    template = """
-    <!DOCTYPE html>
-    <html lang="ja">
-    <head>
-        <meta charset="UTF-8">
-        <title>投資信託ダッシュボード</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 20px; }
-            table { border-collapse: collapse; width: 100%; margin: 20px 0; }
-            th, td { border: 1px solid #ddd; padding: 8px; text-align: center; }
-            th { background-color: #f2f2f2; }
-            .form-group { margin: 10px 0; }
-            input[type="text"], input[type="number"] { padding: 5px; margin: 5px; }
-            button { padding: 8px 15px; background: #0066cc; color: white; border: none; border-radius: 3px; cursor: pointer; }
-            button:hover { background: #0052a3; }
-            .back-link { margin: 20px 0; }
-            .back-link a { color: #0066cc; text-decoration: none; }
-            .delete-btn { background: #dc3545; padding: 4px 8px; font-size: 12px; }
-            .delete-btn:hover { background: #c82333; }
-        </style>
-    </head>
-    <body>
-        <div class="back-link"><a href="{{ url_for('dashboard') }}">← ダッシュボードに戻る</a></div>
-        
-        <h1>投資信託ダッシュボード</h1>
-        
-        <form method="POST" action="{{ url_for('add_fund') }}">
-            <div class="form-group">
-                <input type="text" name="name" placeholder="ファンド名" required>
-                <input type="number" name="qty" step="0.01" placeholder="口数" required>
-                <input type="number" name="price" step="0.01" placeholder="基準価額" required>
-                <button type="submit">追加</button>
-            </div>
-        </form>
-        
-        <table>
-            <tr>
-                <th>ファンド名</th>
-                <th>口数</th>
-                <th>基準価額</th>
-                <th>評価額</th>
-                <th>操作</th>
-            </tr>
-            {% for fund in data.funds %}
-            <tr>
-                <td>{{ fund.name }}</td>
-                <td>{{ "{:,.2f}".format(fund.qty) }}</td>
-                <td>{{ "{:,.2f}".format(fund.price) }} 円</td>
-                <td>{{ "{:,}".format((fund.qty * fund.price)|int) }} 円</td>
-                <td>
-                    <form method="POST" action="{{ url_for('delete_fund') }}" style="display: inline;">
-                        <input type="hidden" name="name" value="{{ fund.name }}">
-                        <button type="submit" class="delete-btn" onclick="return confirm('削除しますか？')">削除</button>
-                    </form>
-                </td>
-            </tr>
-            {% endfor %}
-        </table>
-    </body>
-    </html>
-    """
-    
-    return render_template_string(template, data=data)
+    portfolio = Portfolio(data, None, 0)
+    return render_template('funds.html', data=data, portfolio=portfolio)
 
 @app.route('/add_fund', methods=['POST'])
 def add_fund():
@@ -587,17 +2508,11 @@ def add_fund():
     price = float(request.form['price'])
     
     # 既存のファンドを更新するか新規追加
-    for fund in data['funds']:
-        if fund['name'] == name:
-            fund['qty'] = qty
-            fund['price'] = price
-            break
-    else:
-        data['funds'].append({
-            'name': name,
-            'qty': qty,
-            'price': price
-        })
+    holdings(data, 'funds').upsert({
+        'name': name,
+        'qty': qty,
+        'price': price
+    })
     
     save_data(data)
     return redirect(url_for('funds'))
@@ -607,7 +2522,7 @@ def delete_fund():
     """投資信託を削除"""
     data = load_data()
     name = request.form['name']
-    data['funds'] = [fund for fund in data['funds'] if fund['name'] != name]
+    holdings(data, 'funds').delete(name)
     save_data(data)
     return redirect(url_for('funds'))
 
@@ -618,56 +2533,7 @@ def gold():
     gold_price = get_gold_price()
     gold_total = data['gold_qty'] * gold_price
     
-    template = """
-    <!DOCTYPE html>
-    <html lang="ja">
-    <head>
-        <meta charset="UTF-8">
-        <title>金ダッシュボード</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 20px; }
-            table { border-collapse: collapse; width: 100%; margin: 20px 0; }
-            th, td { border: 1px solid #ddd; padding: 8px; text-align: center; }
-            th { background-color: #f2f2f2; }
-            .form-group { margin: 10px 0; }
-            input[type="number"] { padding: 5px; margin: 5px; }
-            button { padding: 8px 15px; background: #0066cc; color: white; border: none; border-radius: 3px; cursor: pointer; }
-            button:hover { background: #0052a3; }
-            .back-link { margin: 20px 0; }
-            .back-link a { color: #0066cc; text-decoration: none; }
-        </style>
-    </head>
-    <body>
-        <div class="back-link"><a href="{{ url_for('dashboard') }}">← ダッシュボードに戻る</a></div>
-        
-        <h1>金ダッシュボード</h1>
-        
-        <form method="POST" action="{{ url_for('update_gold') }}">
-            <div class="form-group">
-                <input type="number" name="qty" step="0.1" placeholder="数量(g)" value="{{ data.gold_qty }}" required>
-                <button type="submit">更新</button>
-            </div>
-        </form>
-        
-        <table>
-            <tr>
-                <th>資産</th>
-                <th>数量</th>
-                <th>価格</th>
-                <th>評価額</th>
-            </tr>
-            <tr>
-                <td>金 (Gold)</td>
-                <td>{{ data.gold_qty }} g</td>
-                <td>{{ "{:,}".format(gold_price) }} 円/g</td>
-                <td>{{ "{:,}".format(gold_total|int) }} 円</td>
-            </tr>
-        </table>
-    </body>
-    </html>
-    """
-    
-    return render_template_string(template, data=data, gold_price=gold_price, gold_total=gold_total)
+    return render_template('gold.html', data=data, gold_price=gold_price, gold_total=gold_total)
 
 @app.route('/update_gold', methods=['POST'])
 def update_gold():
@@ -682,60 +2548,7 @@ def cash():
     """現金管理ページ（投資信託風デザイン）"""
     data = load_data()
     total_cash = sum(item['amount'] for item in data.get('cash_items', []))
-    template = """
-    <!DOCTYPE html>
-    <html lang=\"ja">
-    <head>
-        <meta charset=\"UTF-8">
-        <title>現金管理</title>
-        <style>
-            body { font-family: Arial, sans-serif; margin: 20px; }
-            .form-group { margin: 10px 0; }
-            input[type="text"], input[type="number"] { padding: 5px; margin: 5px; }
-            button { padding: 8px 15px; background: #0066cc; color: white; border: none; border-radius: 3px; cursor: pointer; }
-            button:hover { background: #0052a3; }
-            .back-link { margin: 20px 0; }
-            .back-link a { color: #0066cc; text-decoration: none; }
-            .current-amount { font-size: 24px; color: #0066cc; margin: 20px 0; }
-            table { border-collapse: collapse; width: 100%; margin: 20px 0; }
-            th, td { border: 1px solid #ddd; padding: 8px; text-align: center; }
-            th { background-color: #f2f2f2; }
-            .delete-btn { background: #dc3545; padding: 6px 16px; font-size: 16px; color: #fff; border: none; border-radius: 4px; cursor: pointer; }
-            .delete-btn:hover { background: #c82333; }
-        </style>
-    </head>
-    <body>
-        <div class=\"back-link\"><a href=\"{{ url_for('dashboard') }}\">← ダッシュボードに戻る</a></div>
-        <h1>現金管理ダッシュボード</h1>
-        <form method=\"POST\" action=\"{{ url_for('add_cash_item') }}\">
-            <div class=\"form-group\">
-                <input type=\"text\" name=\"label\" placeholder=\"項目\" required>
-                <input type=\"number\" name=\"amount\" step=\"1\" placeholder=\"金額\" required>
-                <button type=\"submit\">追加</button>
-            </div>
-        </form>
-        <table>
-            <tr><th>項目</th><th>金額</th><th>操作</th></tr>
-            {% for item in data.cash_items %}
-            <tr>
-                <td>{{ item.label }}</td>
-                <td>{{ "{:,}".format(item.amount|int) }} 円</td>
-                <td>
-                    <form method=\"POST\" action=\"{{ url_for('delete_cash_item') }}\" style=\"display:inline;\">
-                        <input type=\"hidden\" name=\"label\" value=\"{{ item.label }}\">
-                        <button type=\"submit\" class=\"delete-btn\">削除</button>
-                    </form>
-                </td>
-            </tr>
-            {% endfor %}
-        </table>
-        <div class=\"current-amount\">
-            合計現金: {{ "{:,}".format(total_cash|int) }} 円
-        </div>
-    </body>
-    </html>
-    """
-    return render_template_string(template, data=data, total_cash=total_cash)
+    return render_template('cash.html', data=data, total_cash=total_cash)
 
 @app.route('/add_cash_item', methods=['POST'])
 def add_cash_item():
@@ -744,19 +2557,16 @@ def add_cash_item():
     label = request.form['label']
     amount = int(request.form['amount'])
     
-    # 既存の現金項目を更新するか新規追加
-    for item in data.get('cash_items', []):
-        if item['label'] == label:
-            item['amount'] += amount
-            break
-    else:
-        data.setdefault('cash_items', []).append({
-            'label': label,
-            'amount': amount
-        })
+    # 既存の現金項目に加算するか新規追加
+    cash_items = holdings(data, 'cash_items')
+    existing = cash_items.get(label)
+    cash_items.upsert({
+        'label': label,
+        'amount': amount + (existing['amount'] if existing else 0)
+    })
     
     # 現金合計を再計算
-    total_cash = sum(item['amount'] for item in data.get('cash_items', []))
+    total_cash = sum(item['amount'] for item in cash_items)
     data['cash_jpy'] = total_cash
     
     save_data(data)
@@ -767,10 +2577,11 @@ def delete_cash_item():
     """現金項目を削除"""
     data = load_data()
     label = request.form['label']
-    data['cash_items'] = [item for item in data.get('cash_items', []) if item['label'] != label]
+    cash_items = holdings(data, 'cash_items')
+    cash_items.delete(label)
     
     # 現金合計を再計算
-    total_cash = sum(item['amount'] for item in data.get('cash_items', []))
+    total_cash = sum(item['amount'] for item in cash_items)
     data['cash_jpy'] = total_cash
     
     save_data(data)
@@ -783,51 +2594,212 @@ def delete_cash_item():
 def api_dashboard():
     try:
         data = load_data()
-        usd_jpy = get_usd_jpy_rate()
-        jp_total = sum(stock['qty'] * stock['price'] for stock in data.get('jp_stocks', []))
-        us_total_usd = sum(stock['qty'] * stock['price'] for stock in data.get('us_stocks', []))
-        us_total_jpy = int(us_total_usd * usd_jpy) if usd_jpy else 0
-        fund_total = sum(fund['qty'] * fund['price'] for fund in data.get('funds', []))
-        gold_price = get_gold_price()
-        gold_total = (data.get('gold_qty') or 0) * gold_price
-        cash_total = sum(item['amount'] for item in data.get('cash_items', []))
-        return jsonify({
-            'jp_total': jp_total,
-            'us_total_usd': us_total_usd,
-            'us_total_jpy': us_total_jpy,
-            'fund_total': fund_total,
-            'gold_total': gold_total,
-            'cash_total': cash_total,
-            'grand_total': jp_total + us_total_jpy + fund_total + gold_total + cash_total,
-            'usd_jpy': usd_jpy,
-            'last_updated': data.get('last_updated')
+
+        def build():
+            market, portfolio = dashboard_portfolio(data)
+            return document_etag(data, market), app.json.dumps(dashboard_payload(data, market, portfolio))
+
+        etag, body = cached_fragment(data, 'api_dashboard', build)
+        return conditional_json(etag, lambda: body)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/snapshot', methods=['GET'])
+@login_required
+def api_snapshot():
+    """SPAの初回表示用：全資産・評価額・レートを1回の読み込みでまとめて返す"""
+    try:
+        data = load_data()
+        market = fetch_market_data(data, fx=True, gold=True)
+        apply_prices(data, market['prices'])
+        return conditional_json(document_etag(data, market), lambda: {
+            'dashboard': dashboard_payload(data, market, Portfolio(data, market['usd_jpy'], market['gold_price'])),
+            'jp_stocks': data.get('jp_stocks', []),
+            'us_stocks': data.get('us_stocks', []),
+            'funds': data.get('funds', []),
+            'cash': data.get('cash_items', []),
+            'gold': {'qty': data.get('gold_qty', 0), 'price': market['gold_price']},
         })
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/fx', methods=['GET'])
+@login_required
+def api_fx():
+    return jsonify({'usd_jpy': get_usd_jpy_rate(), 'age': get_usd_jpy_age()})
+
+@app.route('/api/upstreams', methods=['GET'])
+@login_required
+def api_upstreams():
+    """上流ごとのサーキットブレーカーの状態（このワーカーのもの）"""
+    return jsonify({name: breaker.status() for name, breaker in breakers.items()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheusのテキスト形式のメトリクス（このワーカーのもの、METRICS_TOKEN が未設定なら認証なし）"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                                                 f'Bearer {METRICS_TOKEN}'.encode()):
+        abort(401)
+    return app.response_class(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/stream', methods=['GET'])
+@login_required
+def api_stream():
+    """USD/JPY・金価格・保有銘柄の株価が変わったときだけ差分をServer-Sent Eventsで送る"""
+    user_id = current_user.id
+    symbols = holding_symbols(load_data())
+    events = price_stream.subscribe(user_id, symbols)
+    if events is None:
+        return jsonify({'error': 'Too many streams'}), 503
+
+    def generate():
+        try:
+            yield 'retry: 5000\n\n'
+            initial = price_stream.current(symbols)
+            if initial['usd_jpy'] is not None:
+                yield f"data: {json.dumps(initial, separators=(',', ':'))}\n\n"
+            while True:
+                try:
+                    event = events.get(timeout=STREAM_HEARTBEAT)
+                except queue.Empty:
+                    yield ': ping\n\n'
+                    continue
+                yield f"data: {json.dumps(event, separators=(',', ':'))}\n\n"
+        finally:
+            price_stream.unsubscribe(events)
+
+    return app.response_class(generate(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- 一括登録 ---
+# POSTの本文がJSON配列またはCSVなら、全行を検証してからキーで上書き・追加し、1回だけ保存する。
+BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', 5000))
+
+def _to_int(value):
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError(value)
+    return int(number)
+
+def _to_float(value):
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(value)
+    return number
+
+# 資産クラス -> (キー, {項目: 変換関数}, 必須項目)
+BULK_FIELDS = {
+    'jp_stocks': ('code', {'code': str, 'name': str, 'qty': _to_int, 'price': _to_float}, ('code', 'qty', 'price')),
+    'us_stocks': ('symbol', {'symbol': str, 'name': str, 'qty': _to_float, 'price': _to_float}, ('symbol', 'qty', 'price')),
+    'funds': ('name', {'name': str, 'qty': _to_float, 'price': _to_float}, ('name', 'qty', 'price')),
+    'cash_items': ('label', {'label': str, 'amount': _to_int}, ('label', 'amount')),
+}
+
+def decode_csv(body, charset=None):
+    """CSVの本文を文字列にする（charset指定がなければUTF-8（BOM付き可）、だめならExcelのShift_JIS（cp932））"""
+    if charset and charset.lower().replace('_', '-') in ('utf-8', 'utf8'):
+        charset = 'utf-8-sig'  # Excelで保存したCSVのBOMも受け付ける
+    for encoding in ([charset] if charset else ['utf-8-sig', 'cp932']):
+        try:
+            return body.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            continue
+    res = jsonify({'error': 'CSV must be UTF-8 or Shift_JIS'})
+    res.status_code = 400
+    abort(res)
+
+def bulk_rows():
+    """一括登録の行のリスト（JSON配列またはtext/csv）。1件ずつの登録ならNone"""
+    if request.mimetype == 'text/csv':
+        text = decode_csv(request.get_data(), request.mimetype_params.get('charset'))
+        return [{k.strip(): (v or '').strip() for k, v in row.items() if k is not None}
+                for row in csv.DictReader(io.StringIO(text))]
+    rows = request.get_json(silent=True)
+    return rows if isinstance(rows, list) else None
+
+def validate_bulk_row(asset, row):
+    """1行を検証して保存用の項目にする（不正ならValueError）"""
+    _, fields, required = BULK_FIELDS[asset]
+    if not isinstance(row, dict):
+        raise ValueError('Invalid input')
+    missing = [name for name in required if row.get(name) in (None, '')]
+    if missing:
+        raise ValueError(f"Missing {', '.join(missing)}")
+    item = {}
+    for name, convert in fields.items():
+        value = row.get(name)
+        if value in (None, ''):
+            continue
+        try:
+            item[name] = convert(value).strip() if convert is str else convert(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid {name}')
+    return item
+
+def validate_single_row(asset, row):
+    """1件ずつのJSON登録の検証（整数の項目は従来どおり小数を切り捨てて受け付ける）"""
+    if isinstance(row, dict):
+        _, fields, _ = BULK_FIELDS[asset]
+        row = {name: int(value) if fields.get(name) is _to_int and isinstance(value, float) and math.isfinite(value)
+               else value for name, value in row.items()}
+    return validate_bulk_row(asset, row)
+
+def bulk_upsert(data, asset, items):
+    """キーが同じ項目は上書き、新しいキーは末尾に追加（既存の並び順は保つ）"""
+    index = holdings(data, asset)
+    inserted = updated = 0
+    for item in items:
+        if asset in ('jp_stocks', 'us_stocks') and item[index.key] not in index:
+            item.setdefault('name', item[index.key])
+        if index.upsert(item):
+            inserted += 1
+        else:
+            updated += 1
+    return inserted, updated
+
+def bulk_import(data, asset, rows):
+    """全行を検証し、エラーがなければまとめて登録して1回だけ保存する"""
+    if not rows:
+        return jsonify({'error': 'No rows'}), 400
+    if len(rows) > BULK_MAX_ROWS:
+        return jsonify({'error': f'Too many rows (max {BULK_MAX_ROWS})'}), 400
+    items, errors = [], []
+    for row_number, row in enumerate(rows, 1):
+        try:
+            items.append(validate_bulk_row(asset, row))
+        except ValueError as e:
+            errors.append({'row': row_number, 'error': str(e)})
+    if errors:
+        # 1行でも不正なら何も保存しない
+        return jsonify({'error': 'Invalid rows', 'errors': errors}), 400
+    inserted, updated = bulk_upsert(data, asset, items)
+    save_data(data)
+    return jsonify({'result': 'ok', 'inserted': inserted, 'updated': updated})
+
 @app.route('/api/jp_stocks', methods=['GET', 'POST', 'DELETE'])
 @login_required
 def api_jp_stocks():
     data = load_data()
     if request.method == 'GET':
-        return jsonify(data.get('jp_stocks', []))
+        market = {'prices': get_portfolio_prices({'jp_stocks': data.get('jp_stocks', [])})}
+        apply_prices(data, market['prices'])
+        return conditional_json(document_etag(data, market), lambda: data.get('jp_stocks', []))
     elif request.method == 'POST':
-        item = request.json
-        if not item or 'code' not in item or 'qty' not in item or 'price' not in item:
-            return jsonify({'error': 'Invalid input'}), 400
+        rows = bulk_rows()
+        if rows is not None:
+            return bulk_import(data, 'jp_stocks', rows)
         try:
-            item['qty'] = int(item['qty'])
-            item['price'] = float(item['price'])
-        except Exception:
-            return jsonify({'error': 'Invalid qty or price'}), 400
-        data.setdefault('jp_stocks', []).append(item)
+            item = validate_single_row('jp_stocks', request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        bulk_upsert(data, 'jp_stocks', [item])
         save_data(data)
         return jsonify({'result': 'ok'})
     elif request.method == 'DELETE':
         code = request.json.get('code')
         if not code:
             return jsonify({'error': 'Code required'}), 400
-        data['jp_stocks'] = [s for s in data.get('jp_stocks', []) if s['code'] != code]
+        holdings(data, 'jp_stocks').delete(code)
         save_data(data)
         return jsonify({'result': 'ok'})
 
@@ -836,24 +2808,25 @@ def api_jp_stocks():
 def api_us_stocks():
     data = load_data()
     if request.method == 'GET':
-        return jsonify(data.get('us_stocks', []))
+        market = {'prices': get_portfolio_prices({'us_stocks': data.get('us_stocks', [])})}
+        apply_prices(data, market['prices'])
+        return conditional_json(document_etag(data, market), lambda: data.get('us_stocks', []))
     elif request.method == 'POST':
-        item = request.json
-        if not item or 'symbol' not in item or 'qty' not in item or 'price' not in item:
-            return jsonify({'error': 'Invalid input'}), 400
+        rows = bulk_rows()
+        if rows is not None:
+            return bulk_import(data, 'us_stocks', rows)
         try:
-            item['qty'] = float(item['qty'])
-            item['price'] = float(item['price'])
-        except Exception:
-            return jsonify({'error': 'Invalid qty or price'}), 400
-        data.setdefault('us_stocks', []).append(item)
+            item = validate_single_row('us_stocks', request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        bulk_upsert(data, 'us_stocks', [item])
         save_data(data)
         return jsonify({'result': 'ok'})
     elif request.method == 'DELETE':
         symbol = request.json.get('symbol')
         if not symbol:
             return jsonify({'error': 'Symbol required'}), 400
-        data['us_stocks'] = [s for s in data.get('us_stocks', []) if s['symbol'] != symbol]
+        holdings(data, 'us_stocks').delete(symbol)
         save_data(data)
         return jsonify({'result': 'ok'})
 
@@ -862,24 +2835,23 @@ def api_us_stocks():
 def api_funds():
     data = load_data()
     if request.method == 'GET':
-        return jsonify(data.get('funds', []))
+        return conditional_json(document_etag(data), lambda: data.get('funds', []))
     elif request.method == 'POST':
-        item = request.json
-        if not item or 'name' not in item or 'qty' not in item or 'price' not in item:
-            return jsonify({'error': 'Invalid input'}), 400
+        rows = bulk_rows()
+        if rows is not None:
+            return bulk_import(data, 'funds', rows)
         try:
-            item['qty'] = float(item['qty'])
-            item['price'] = float(item['price'])
-        except Exception:
-            return jsonify({'error': 'Invalid qty or price'}), 400
-        data.setdefault('funds', []).append(item)
+            item = validate_single_row('funds', request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        bulk_upsert(data, 'funds', [item])
         save_data(data)
         return jsonify({'result': 'ok'})
     elif request.method == 'DELETE':
         name = request.json.get('name')
         if not name:
             return jsonify({'error': 'Name required'}), 400
-        data['funds'] = [f for f in data.get('funds', []) if f['name'] != name]
+        holdings(data, 'funds').delete(name)
         save_data(data)
         return jsonify({'result': 'ok'})
 
@@ -889,7 +2861,8 @@ def api_gold():
     data = load_data()
     if request.method == 'GET':
         gold_price = get_gold_price()
-        return jsonify({'qty': data.get('gold_qty', 0), 'price': gold_price})
+        return conditional_json(document_etag(data, {'gold_price': gold_price}),
+                                lambda: {'qty': data.get('gold_qty', 0), 'price': gold_price})
     elif request.method == 'POST':
         qty = request.json.get('qty')
         try:
@@ -905,26 +2878,50 @@ def api_gold():
 def api_cash():
     data = load_data()
     if request.method == 'GET':
-        return jsonify(data.get('cash_items', []))
+        return conditional_json(document_etag(data), lambda: data.get('cash_items', []))
     elif request.method == 'POST':
-        item = request.json
-        if not item or 'label' not in item or 'amount' not in item:
-            return jsonify({'error': 'Invalid input'}), 400
+        rows = bulk_rows()
+        if rows is not None:
+            return bulk_import(data, 'cash_items', rows)
         try:
-            item['amount'] = int(item['amount'])
-        except Exception:
-            return jsonify({'error': 'Invalid amount'}), 400
-        data.setdefault('cash_items', []).append(item)
+            item = validate_single_row('cash_items', request.get_json(silent=True))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        bulk_upsert(data, 'cash_items', [item])
         save_data(data)
         return jsonify({'result': 'ok'})
     elif request.method == 'DELETE':
         label = request.json.get('label')
         if not label:
             return jsonify({'error': 'Label required'}), 400
-        data['cash_items'] = [c for c in data.get('cash_items', []) if c['label'] != label]
+        holdings(data, 'cash_items').delete(label)
         save_data(data)
         return jsonify({'result': 'ok'})
 
+@app.route('/api/history', methods=['GET'])
+@login_required
+def api_history():
+    """評価額の履歴（range=1m/3m/6m/1y/5y/all）"""
+    range_name = request.args.get('range', '1m')
+    if range_name not in HISTORY_RANGES:
+        return jsonify({'error': 'Invalid range'}), 400
+    try:
+        rows = load_history(current_user.id)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    days = HISTORY_RANGES[range_name]
+    if days is not None:
+        since = (datetime.now(JST) - timedelta(days=days)).strftime('%Y-%m-%d')
+        rows = [row for row in rows if row['date'] >= since]
+    etag = hashlib.sha1(json.dumps([request.endpoint, current_user.id, range_name, rows]).encode('utf-8')).hexdigest()
+    return conditional_json(etag, lambda: {'range': range_name, 'columns': HISTORY_COLUMNS, 'history': rows})
+
+# --- SPA ---
+@app.route('/app')
+def spa():
+    """SPA（docs/index.html）をAPIと同じオリジンから配信（毎回ETagで再検証させる）"""
+    return send_from_directory(os.path.join(app.root_path, 'docs'), 'index.html', max_age=0)
+
 # --- SPA用API認証エンドポイント追加 ---
 from flask_login import login_user, logout_user
 
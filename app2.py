@@ -1,11 +1,16 @@
-from flask import Flask, render_template_string, request, redirect, url_for, session
+from flask import Flask, render_template_string, request, redirect, url_for, session, g
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 import yfinance as yf
 import requests
 import re
 from bs4 import BeautifulSoup
+import copy
 import json
 import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, timezone
 
 app = Flask(__name__)
@@ -38,15 +43,12 @@ def get_data_file():
         return f'asset_data_{current_user.id}.json'
     return 'asset_data_guest.json'
 
-def load_data():
-    """ユーザーごとのデータファイルから資産情報を読み込み"""
-    data_file = get_data_file()
-    if os.path.exists(data_file):
-        try:
-            with open(data_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            pass
+def get_user_key():
+    if current_user.is_authenticated:
+        return current_user.id
+    return 'guest'
+
+def empty_data():
     return {
         'jp_stocks': [],
         'us_stocks': [],
@@ -57,48 +59,224 @@ def load_data():
         'last_updated': None
     }
 
+# --- SQLiteストレージ ---
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')  # 'json' または 'sqlite'
+SQLITE_DB_FILE = os.environ.get('SQLITE_DB_FILE', 'asset_data.sqlite3')
+
+SQLITE_TABLES = {
+    # 資産クラス: (キー列, その他の列)
+    'jp_stocks': ('code', ['name', 'qty', 'price']),
+    'us_stocks': ('symbol', ['name', 'qty', 'price']),
+    'funds': ('name', ['qty', 'price']),
+    'cash_items': ('label', ['amount']),
+}
+
+_sqlite_local = threading.local()
+
+def get_db():
+    """スレッドごとのSQLite接続（WALモード）"""
+    conn = getattr(_sqlite_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(SQLITE_DB_FILE, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for table, (key, columns) in SQLITE_TABLES.items():
+            # 数値列はNUMERICにして整数の数量は整数のまま戻す
+            column_defs = ', '.join(f"{c} {'TEXT' if c == 'name' else 'NUMERIC'}" for c in columns)
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                user_id TEXT NOT NULL, {key} TEXT NOT NULL, {column_defs}, position INTEGER NOT NULL,
+                PRIMARY KEY (user_id, {key}))""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS meta (
+            user_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (user_id, key))""")
+        _sqlite_local.conn = conn
+    return conn
+
+def sqlite_load(user_id):
+    """SQLiteからユーザーの資産情報を読み込み"""
+    conn = get_db()
+    data = empty_data()
+    for table, (key, columns) in SQLITE_TABLES.items():
+        fields = [key] + columns
+        rows = conn.execute(f"SELECT {', '.join(fields)} FROM {table} WHERE user_id = ? ORDER BY position",
+                            (user_id,))
+        data[table] = [dict(zip(fields, row)) for row in rows]
+    for key, value in conn.execute('SELECT key, value FROM meta WHERE user_id = ?', (user_id,)):
+        data[key] = json.loads(value)
+    return data
+
+def _keyed(items, key):
+    return {item[key]: item for item in items}
+
+def sqlite_save(user_id, data, base=None):
+    """読み込み時点(base)からの差分だけを行単位でupsert・deleteする
+
+    baseがNoneの場合はDBの現在の内容との差分を取る（インポート用）。
+    """
+    conn = get_db()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if base is None:
+            base = sqlite_load(user_id)
+        for table, (key, columns) in SQLITE_TABLES.items():
+            old = _keyed(base.get(table, []), key)
+            new = _keyed(data.get(table, []), key)
+            for code in old.keys() - new.keys():
+                conn.execute(f"DELETE FROM {table} WHERE user_id = ? AND {key} = ?", (user_id, code))
+            changed = [item for code, item in new.items()
+                       if code not in old or any(old[code].get(c) != item.get(c) for c in columns)]
+            if not changed:
+                continue
+            next_position = conn.execute(f"SELECT COALESCE(MAX(position), -1) + 1 FROM {table} WHERE user_id = ?",
+                                         (user_id,)).fetchone()[0]
+            for item in changed:
+                values = [item.get(c) for c in columns]
+                conn.execute(
+                    f"""INSERT INTO {table} (user_id, {key}, {', '.join(columns)}, position)
+                        VALUES (?, ?, {', '.join('?' for _ in columns)}, ?)
+                        ON CONFLICT (user_id, {key}) DO UPDATE SET
+                        {', '.join(f'{c} = excluded.{c}' for c in columns)}""",
+                    [user_id, item[key]] + values + [next_position])
+                next_position += 1
+        old_meta = {k: v for k, v in base.items() if k not in SQLITE_TABLES}
+        new_meta = {k: v for k, v in data.items() if k not in SQLITE_TABLES}
+        for k in old_meta.keys() - new_meta.keys():
+            conn.execute('DELETE FROM meta WHERE user_id = ? AND key = ?', (user_id, k))
+        for k, v in new_meta.items():
+            if k not in old_meta or old_meta[k] != v:
+                conn.execute('INSERT INTO meta (user_id, key, value) VALUES (?, ?, ?) '
+                             'ON CONFLICT (user_id, key) DO UPDATE SET value = excluded.value',
+                             (user_id, k, json.dumps(v, ensure_ascii=False)))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def import_json_files(directory='.'):
+    """既存の asset_data_<user>.json をSQLiteに取り込む"""
+    imported = {}
+    for filename in sorted(os.listdir(directory)):
+        match = re.fullmatch(r'asset_data_(.+)\.json', filename)
+        if not match:
+            continue
+        with open(os.path.join(directory, filename), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        sqlite_save(match.group(1), data)
+        imported[match.group(1)] = data
+    return imported
+
+@app.cli.command('import-json')
+def import_json_command():
+    """asset_data_<user>.json をSQLiteに取り込む"""
+    for user_id, data in import_json_files().items():
+        counts = ', '.join(f"{table}={len(data.get(table, []))}" for table in SQLITE_TABLES)
+        print(f"{user_id}: {counts}")
+
+def load_data():
+    """ユーザーごとのデータファイルから資産情報を読み込み"""
+    if STORAGE_BACKEND == 'sqlite':
+        data = sqlite_load(get_user_key())
+        # 保存時に差分を取るため読み込んだ時点の内容を覚えておく
+        g.loaded_data = copy.deepcopy(data)
+        return data
+    data_file = get_data_file()
+    if os.path.exists(data_file):
+        try:
+            with open(data_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except:
+            pass
+    return empty_data()
+
 def save_data(data):
     """ユーザーごとのデータファイルに保存"""
     # JSTで保存
     jst = timezone(timedelta(hours=9))
     data['last_updated'] = datetime.now(jst).strftime('%Y-%m-%d %H:%M:%S')
+    if STORAGE_BACKEND == 'sqlite':
+        sqlite_save(get_user_key(), data, g.get('loaded_data'))
+        g.loaded_data = copy.deepcopy(data)
+        return
     data_file = get_data_file()
     with open(data_file, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
+# --- 株価キャッシュ ---
+QUOTE_CACHE_TTL = int(os.environ.get('QUOTE_CACHE_TTL', 300))  # 秒
+QUOTE_CACHE_MAXSIZE = int(os.environ.get('QUOTE_CACHE_MAXSIZE', 1024))
+
+class QuoteCache:
+    """銘柄ごとの株価キャッシュ（TTL・LRU・stale-while-revalidate）"""
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (value, fetched_at)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """キャッシュから取得。期限切れなら古い値を返しつつ裏で1回だけ更新する"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                value, fetched_at = entry
+                if time.time() - fetched_at >= self.ttl and key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                return dict(value)
+        value = loader()
+        self.set(key, value)
+        return dict(value)
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _refresh(self, key, loader):
+        try:
+            self.set(key, loader())
+        except Exception as e:
+            # 取得失敗時は古い値を使い続ける
+            print(f"Quote refresh error ({key}): {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+quote_cache = QuoteCache(QUOTE_CACHE_TTL, QUOTE_CACHE_MAXSIZE)
+
+def _fetch_stock_info(yf_symbol, default_name):
+    """yfinanceから銘柄名と株価を取得（取得できない場合は例外）"""
+    ticker = yf.Ticker(yf_symbol)
+    info = ticker.info
+    current_price = info.get('currentPrice', 0)
+    if current_price == 0:
+        hist = ticker.history(period="1d")
+        if not hist.empty:
+            current_price = hist['Close'].iloc[-1]
+    if not current_price:
+        raise ValueError(f'price not found: {yf_symbol}')
+    return {
+        'name': info.get('longName', default_name),
+        'price': round(current_price, 2)
+    }
+
 def get_jp_stock_info(code):
     """日本株の情報を取得"""
+    key = f"{code.strip().upper()}.T"
     try:
-        ticker = yf.Ticker(f"{code}.T")
-        info = ticker.info
-        current_price = info.get('currentPrice', 0)
-        if current_price == 0:
-            hist = ticker.history(period="1d")
-            if not hist.empty:
-                current_price = hist['Close'].iloc[-1]
-        
-        return {
-            'name': info.get('longName', f'Stock {code}'),
-            'price': round(current_price, 2) if current_price else 0
-        }
+        return quote_cache.get(key, lambda: _fetch_stock_info(key, f'Stock {code}'))
     except:
         return {'name': f'Stock {code}', 'price': 0}
 
 def get_us_stock_info(symbol):
     """米国株の情報を取得"""
+    key = symbol.strip().upper()
     try:
-        ticker = yf.Ticker(symbol)
-        info = ticker.info
-        current_price = info.get('currentPrice', 0)
-        if current_price == 0:
-            hist = ticker.history(period="1d")
-            if not hist.empty:
-                current_price = hist['Close'].iloc[-1]
-        
-        return {
-            'name': info.get('longName', symbol),
-            'price': round(current_price, 2) if current_price else 0
-        }
+        return quote_cache.get(key, lambda: _fetch_stock_info(key, symbol))
     except:
         return {'name': symbol, 'price': 0}
 
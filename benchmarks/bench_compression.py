@@ -0,0 +1,76 @@
+"""レスポンス圧縮のベンチマーク
+
+主なエンドポイントについて、符号化ごと（identity / gzip / br）の転送バイト数と、
+圧縮にかかるCPU時間（初回の圧縮と、圧縮済みキャッシュを使った2回目以降）を出力する。
+Sheets・株価・為替・金価格は固定値に差し替える。
+
+    python benchmarks/bench_compression.py [回数]
+"""
+import copy
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+ENDPOINTS = ['/', '/jp_stocks', '/us_stocks', '/funds', '/gold', '/cash',
+             '/api/dashboard', '/api/snapshot', '/api/jp_stocks', '/api/us_stocks', '/app']
+
+
+def sample_data(n=30):
+    return {
+        'jp_stocks': [{'code': str(7200 + i), 'name': f'銘柄{i}', 'qty': 100, 'price': 2500.0 + i} for i in range(n)],
+        'us_stocks': [{'symbol': f'SYM{i}', 'name': f'Company {i}', 'qty': 10, 'price': 150.0 + i} for i in range(n)],
+        'funds': [{'name': f'ファンド{i}', 'qty': 10000, 'price': 1.5} for i in range(n)],
+        'crypto': [],
+        'gold_qty': 100.0,
+        'cash_items': [{'label': f'口座{i}', 'amount': 100000} for i in range(n)],
+        'last_updated': '2024-01-01 00:00:00',
+        'revision': 1,
+    }
+
+
+def cpu_ms(fn, rounds):
+    start = time.process_time()
+    for _ in range(rounds):
+        fn()
+    return (time.process_time() - start) / rounds * 1000
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    data = sample_data()
+    middleware = app.app.wsgi_app
+    encodings = ['identity', 'gzip'] + (['br'] if app.brotli is not None else [])
+    with mock.patch.object(app, '_read_user_data', lambda user_id: copy.deepcopy(data)), \
+            mock.patch.object(app, 'get_batch_prices', lambda symbols: {s: 1000.0 for s in symbols}), \
+            mock.patch.object(app.fx_service, '_fetcher', lambda: 150.0), \
+            mock.patch.object(app.gold_service, '_fetcher', lambda: 12000):
+        client = app.app.test_client()
+        client.post('/login', data={'username': 'user', 'password': 'user'})
+        with app.app.test_request_context():
+            static_path = app.static_url('css/style.css')
+        header = f'{"endpoint":<24}' + ''.join(f'{enc + " B":>11}' for enc in encodings)
+        header += ''.join(f'{enc + " cold ms":>15}{enc + " warm ms":>15}' for enc in encodings[1:])
+        print(header)
+        for path in ENDPOINTS + [static_path]:
+            sizes = {}
+            for enc in encodings:
+                res = client.get(path, headers={'Accept-Encoding': enc})
+                sizes[enc] = len(res.data)
+            body = client.get(path, headers={'Accept-Encoding': 'identity'}).data
+            line = f'{path.split("?")[0]:<24}' + ''.join(f'{sizes[enc]:>11}' for enc in encodings)
+            for enc in encodings[1:]:
+                def cold():
+                    middleware._cache.clear()
+                    middleware.compress(body, enc)
+                cold_ms = cpu_ms(cold, rounds)
+                warm_ms = cpu_ms(lambda: middleware.compress(body, enc), rounds)
+                line += f'{cold_ms:>15.3f}{warm_ms:>15.3f}'
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""金価格パーサのマイクロベンチマーク
+
+保存済みの田中貴金属ページ（fixtures/tanaka_souba_english.html）を使い、
+旧実装（apparent_encoding + BeautifulSoup全体解析）と
+現在の parse_gold_price() の解析時間を比較する。
+
+    python benchmarks/bench_gold_parse.py
+"""
+import os
+import re
+import sys
+import timeit
+
+import requests
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import parse_gold_price  # noqa: E402
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'tanaka_souba_english.html')
+
+
+def make_response(content):
+    res = requests.models.Response()
+    res._content = content
+    res.status_code = 200
+    res.headers['Content-Type'] = 'text/html'
+    return res
+
+
+def old_parse(content):
+    """変更前の get_gold_price() と同じ処理"""
+    res = make_response(content)
+    res.encoding = res.apparent_encoding
+    soup = BeautifulSoup(res.text, "html.parser")
+    for tr in soup.find_all("tr"):
+        tds = tr.find_all("td")
+        if len(tds) > 1 and tds[0].get_text(strip=True).upper() == "GOLD":
+            price_text = tds[1].get_text(strip=True)
+            price_match = re.search(r"([0-9,]+) yen", price_text)
+            if price_match:
+                return int(price_match.group(1).replace(",", ""))
+    return 0
+
+
+def new_parse(content):
+    return parse_gold_price(content.decode('utf-8', errors='replace'))
+
+
+def bench(func, content, number):
+    best = min(timeit.repeat(lambda: func(content), number=number, repeat=5))
+    return best / number * 1000
+
+
+def main():
+    with open(FIXTURE, 'rb') as f:
+        content = f.read()
+    assert old_parse(content) == new_parse(content), 'parsers disagree'
+    print(f'page size: {len(content):,} bytes, GOLD = {new_parse(content):,} yen/g')
+    old_ms = bench(old_parse, content, 20)
+    new_ms = bench(new_parse, content, 200)
+    print(f'old (apparent_encoding + BeautifulSoup): {old_ms:8.3f} ms/parse')
+    print(f'new (parse_gold_price):                  {new_ms:8.3f} ms/parse')
+    print(f'speedup: {old_ms / new_ms:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
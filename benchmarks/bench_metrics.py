@@ -0,0 +1,86 @@
+"""メトリクス記録のオーバーヘッドのベンチマーク
+
+1. Histogram.observe・Counter.inc・upstream_timer の1回あたりの時間（マイクロ秒）と、
+   32スレッドから同時に記録したときの1回あたりの時間。
+2. 軽いルート（/api/fx、為替は固定値）を test_client で叩いたときの1リクエストあたりの時間を、
+   リクエストの記録（before_request / after_request）ありとなしで比較する。
+3. /metrics の出力にかかる時間とサイズ。
+
+    python benchmarks/bench_metrics.py [回数]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('PRICE_REFRESH_INTERVAL', '0')
+os.environ.setdefault('HISTORY_SNAPSHOT', '0')
+os.environ.setdefault('QUOTE_STORE_FILE', os.path.join(tempfile.mkdtemp(), 'quote_store.sqlite3'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+THREADS = 32  # Procfile の --threads
+
+
+def timeit_us(fn, rounds):
+    fn()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def concurrent_us(fn, rounds):
+    """THREADS本のスレッドで合計 rounds 回呼んだときの1回あたりの時間"""
+    per_thread = rounds // THREADS
+    threads = [threading.Thread(target=lambda: [fn() for _ in range(per_thread)]) for _ in range(THREADS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (time.perf_counter() - start) / (per_thread * THREADS) * 1e6
+
+
+def timed_noop():
+    with app.upstream_timer('bench', 'noop'):
+        pass
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    histogram = app.Histogram('bench_seconds', 'bench', ('route',))
+    counter = app.Counter('bench_total', 'bench', ('route', 'status'))
+    print(f'{"operation":<28} {"us/op":>8} {f"{THREADS} threads":>11}')
+    for name, fn in [('Histogram.observe', lambda: histogram.observe(0.012, '/api/dashboard')),
+                     ('Counter.inc', lambda: counter.inc('/api/dashboard', '200')),
+                     ('upstream_timer', timed_noop)]:
+        print(f'{name:<28} {timeit_us(fn, rounds):>8.2f} {concurrent_us(fn, rounds):>11.2f}')
+
+    app.fx_service._fetcher = lambda: 150.0
+    client = app.app.test_client()
+    client.post('/login', data={'username': 'user', 'password': 'user'})
+    request_rounds = max(rounds // 100, 100)
+    before, after = app.app.before_request_funcs[None], app.app.after_request_funcs[None]
+    results = {'without metrics': [], 'with metrics': []}
+    for _ in range(5):  # 交互に測って最小値を使う
+        app.app.before_request_funcs[None] = [f for f in before if f is not app.start_request_timer]
+        app.app.after_request_funcs[None] = [f for f in after if f is not app.record_request_metrics]
+        results['without metrics'].append(timeit_us(lambda: client.get('/api/fx'), request_rounds))
+        app.app.before_request_funcs[None], app.app.after_request_funcs[None] = before, after
+        results['with metrics'].append(timeit_us(lambda: client.get('/api/fx'), request_rounds))
+    without_metrics, with_metrics = min(results['without metrics']), min(results['with metrics'])
+    print()
+    print(f'{"GET /api/fx":<28} {"us/req":>8}')
+    print(f'{"without metrics":<28} {without_metrics:>8.1f}')
+    print(f'{"with metrics":<28} {with_metrics:>8.1f}')
+
+    text = app.render_metrics()
+    print()
+    print(f'render_metrics: {timeit_us(app.render_metrics, 200):.1f} us, {len(text.encode())} B, '
+          f'{len(text.splitlines())} lines')
+
+
+if __name__ == '__main__':
+    main()
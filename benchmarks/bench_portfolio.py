@@ -0,0 +1,97 @@
+"""評価額計算のベンチマーク
+
+1万〜10万件の合成ポートフォリオで、変更前の方式（資産クラスごとのジェネレータ合計と、
+テンプレートでの行ごとの 数量×価格）と、Portfolio で合計と行ごとの評価額を計算する方式を比較する。
+行ごとの評価額の計算だけの時間と、計算済みの Portfolio から合計と行ごとの評価額を取り出す時間
+（HTMLとJSONで共有する場合の2回目以降）も出力する。合計は変更前と同じ式なので差（max diff）は0になる。
+
+    python benchmarks/bench_portfolio.py [件数 ...]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def legacy_totals(data, usd_jpy, gold_price):
+    """変更前の compute_totals"""
+    jp_total = sum(stock['qty'] * stock['price'] for stock in data.get('jp_stocks', []))
+    us_total_usd = sum(stock['qty'] * stock['price'] for stock in data.get('us_stocks', []))
+    us_total_jpy = int(us_total_usd * usd_jpy) if usd_jpy else 0
+    fund_total = sum(fund['qty'] * fund['price'] for fund in data.get('funds', []))
+    gold_total = (data.get('gold_qty') or 0) * gold_price
+    cash_total = sum(item['amount'] for item in data.get('cash_items', []))
+    return jp_total + us_total_jpy + fund_total + gold_total + cash_total
+
+
+def legacy_rows(data, usd_jpy):
+    """変更前にテンプレートで行ごとに計算していた評価額"""
+    jp = [stock['qty'] * stock['price'] for stock in data['jp_stocks']]
+    us = [(stock['qty'] * stock['price'], stock['qty'] * stock['price'] * usd_jpy) for stock in data['us_stocks']]
+    funds = [fund['qty'] * fund['price'] for fund in data['funds']]
+    return jp, us, funds
+
+
+def portfolio_rows(portfolio):
+    jp = portfolio['jp_stocks'].value
+    us = list(zip(portfolio['us_stocks'].value, portfolio['us_stocks'].value_jpy))
+    funds = portfolio['funds'].value
+    return jp, us, funds
+
+
+def synthetic_data(n):
+    """n件を日本株・米国株・投資信託・現金に振り分けた合成データ"""
+    rng = random.Random(n)
+    quarter = n // 4
+    return {
+        'jp_stocks': [{'code': str(1000 + i), 'name': f'銘柄{i}', 'qty': rng.randint(1, 50) * 100,
+                       'price': round(rng.uniform(100, 20000), 1)} for i in range(quarter)],
+        'us_stocks': [{'symbol': f'S{i}', 'name': f'Company {i}', 'qty': rng.randint(1, 500),
+                       'price': round(rng.uniform(5, 900), 2)} for i in range(quarter)],
+        'funds': [{'name': f'ファンド{i}', 'qty': rng.uniform(1000, 1e6), 'price': rng.uniform(0.5, 3)}
+                  for i in range(quarter)],
+        'crypto': [],
+        'gold_qty': 100.0,
+        'cash_items': [{'label': f'口座{i}', 'amount': rng.randint(1, 10000) * 100} for i in range(n - 3 * quarter)],
+    }
+
+
+def timeit(fn, rounds):
+    fn()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 30000, 100000]
+    usd_jpy, gold_price = 150.0, 12000.0
+    print(f'{"positions":>10} {"legacy ms":>10} {"rows ms":>10} {"portfolio ms":>13} {"reuse ms":>10} {"max diff":>10}')
+    for n in sizes:
+        data = synthetic_data(n)
+        rounds = max(3, 200000 // n)
+
+        def legacy():
+            return legacy_totals(data, usd_jpy, gold_price), legacy_rows(data, usd_jpy)
+
+        def vectorized():
+            portfolio = app.Portfolio(data, usd_jpy, gold_price)
+            return portfolio.totals()['grand_total'], portfolio_rows(portfolio)
+
+        built = app.Portfolio(data, usd_jpy, gold_price)
+        portfolio_rows(built)
+        legacy_ms = timeit(legacy, rounds)
+        build_ms = timeit(lambda: [app.Portfolio(data, usd_jpy, gold_price)[asset]
+                                   for asset in ('jp_stocks', 'us_stocks', 'funds')], rounds)
+        portfolio_ms = timeit(vectorized, rounds)
+        reuse_ms = timeit(lambda: (built.totals(), portfolio_rows(built)), rounds)
+        diff = abs(legacy()[0] - built.totals()['grand_total'])
+        print(f'{n:>10} {legacy_ms:>10.2f} {build_ms:>10.2f} {portfolio_ms:>13.2f} {reuse_ms:>10.2f} {diff:>10.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""ワーカー共有の相場ストアのベンチマーク
+
+1. 参照の速さ: 手元だけのキャッシュ（共有なし）と、共有ストア付きのキャッシュの peek、
+   ストアの sync・get・snapshot の1回あたりの時間（マイクロ秒）を出力する。
+   他のワーカーが書き込んだ直後の sync（写しの読み直し）と peek も別に測る。
+   アプリでは sync をリクエストごとに1回だけ行い、peek では行わない。
+2. 上流への取得回数: gunicornのワーカーを模したプロセスを複数起動し、全プロセスが同じ銘柄を
+   参照したときの取得回数を、共有ストアの有無で比較する。
+
+    python benchmarks/bench_quote_store.py [銘柄数] [プロセス数]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('PRICE_REFRESH_INTERVAL', '0')
+os.environ.setdefault('HISTORY_SNAPSHOT', '0')
+os.environ.setdefault('QUOTE_STORE_FILE', os.path.join(tempfile.mkdtemp(), 'quote_store.sqlite3'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+def timeit_us(fn, rounds):
+    fn()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def lookup_latency(symbols, rounds=20000):
+    store = app.SharedQuoteStore(os.path.join(tempfile.mkdtemp(), 'quotes.sqlite3'))
+    local = app.QuoteCache(300, 4096)
+    shared = app.QuoteCache(300, 4096, store=store, kind='price')
+    values = {symbol: {'price': 1000.0 + i} for i, symbol in enumerate(symbols)}
+    local.set_many(values)
+    shared.set_many(values)
+    symbol = symbols[len(symbols) // 2]
+    other = app.SharedQuoteStore(store.path)  # 別のワーカー
+
+    def after_other_write():
+        other.put('price', {symbol: 1000.0})
+        store.sync()
+        return shared.peek(symbol)
+
+    print(f'{"lookup":<28} {"us/op":>8}')
+    print(f'{"local cache peek":<28} {timeit_us(lambda: local.peek(symbol), rounds):>8.2f}')
+    print(f'{"shared cache peek":<28} {timeit_us(lambda: shared.peek(symbol), rounds):>8.2f}')
+    print(f'{"store sync (unchanged)":<28} {timeit_us(store.sync, rounds):>8.2f}')
+    print(f'{"store get":<28} {timeit_us(lambda: store.get("price", symbol), rounds):>8.2f}')
+    print(f'{"store snapshot (" + str(len(symbols)) + ")":<28} '
+          f'{timeit_us(lambda: store.snapshot("price", 300), rounds // 10):>8.2f}')
+    write_us = timeit_us(lambda: other.put('price', {symbol: 1000.0}), rounds // 100)
+    print(f'{"other worker put":<28} {write_us:>8.2f}')
+    print(f'{"put + sync + peek (reload)":<28} {timeit_us(after_other_write, rounds // 100) - write_us:>8.2f}')
+
+
+def worker(path, symbols, counter, shared):
+    """ワーカー1つ分: 全銘柄を参照し、上流への取得回数を数える"""
+    store = app.SharedQuoteStore(path) if shared else None
+    cache = app.QuoteCache(300, 4096, store=store, kind='price')
+
+    def loader():
+        with counter.get_lock():
+            counter.value += 1
+        time.sleep(0.005)  # 上流の応答待ち
+        return {'price': 1000.0}
+
+    for symbol in symbols:
+        if store is not None:
+            store.sync()  # リクエストの開始時と同じ
+        cache.get(symbol, loader)
+
+
+def fetch_counts(symbols, processes):
+    print(f'{"store":<8} {"processes":>10} {"symbols":>8} {"fetches":>8}')
+    for shared in (False, True):
+        path = os.path.join(tempfile.mkdtemp(), 'quotes.sqlite3')
+        counter = multiprocessing.Value('i', 0)
+        # ワーカーの起動をずらして、先に取得したワーカーの結果を後のワーカーが使えるようにする
+        procs = []
+        for i in range(processes):
+            proc = multiprocessing.Process(target=worker, args=(path, symbols, counter, shared))
+            proc.start()
+            procs.append(proc)
+            time.sleep(0.05)
+        for proc in procs:
+            proc.join()
+        print(f'{"shared" if shared else "local":<8} {processes:>10} {len(symbols):>8} {counter.value:>8}')
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    symbols = [f'{7000 + i}.T' for i in range(n)]
+    lookup_latency(symbols)
+    print()
+    fetch_counts(symbols[:50], processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Google Sheetsへのリクエスト回数ベンチマーク
+
+1回のPOST（load_data + save_data）あたりに発生するHTTPリクエスト数を、
+変更前（毎回認証・open_by_key・worksheet検索）と現在の SheetsPool で比較する。
+Sheets APIとトークン取得は偽のレスポンスに差し替えて回数だけを数える。
+
+    python benchmarks/bench_sheets_calls.py
+"""
+import json
+import os
+import sys
+from collections import Counter
+from unittest import mock
+
+import gspread
+import requests
+from flask_login import login_user
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+calls = Counter()
+SHEET_TITLE = 'user_data'
+cell_value = json.dumps({'jp_stocks': [], 'us_stocks': [], 'funds': [], 'crypto': [],
+                         'gold_qty': 0, 'cash_items': [], 'last_updated': None})
+
+
+class FakeCredentials:
+    """初回リクエスト時にトークンを取得する認証情報"""
+
+    def __init__(self):
+        calls['read credentials.json'] += 1
+        self.token = None
+
+
+def fake_response(payload):
+    res = requests.models.Response()
+    res.status_code = 200
+    res._content = json.dumps(payload).encode()
+    return res
+
+
+def fake_request(self, method, endpoint, params=None, data=None, json=None, files=None, headers=None):
+    if self.auth.token is None:
+        calls['POST oauth2/token'] += 1
+        self.auth.token = 'token'
+    if '/values' in endpoint and method == 'get':
+        calls['GET values (A1)'] += 1
+        return fake_response({'range': f'{SHEET_TITLE}!A1', 'majorDimension': 'ROWS', 'values': [[cell_value]],
+                              'valueRanges': [{'range': f'{SHEET_TITLE}!A1', 'values': [[cell_value]]}]})
+    if '/values/' in endpoint:
+        calls['PUT values (A1)'] += 1
+        return fake_response({'updatedRange': f'{SHEET_TITLE}!A1'})
+    calls['GET spreadsheet metadata'] += 1
+    return fake_response({'spreadsheetId': app.GSHEET_SPREADSHEET_ID,
+                          'properties': {'title': 'assets'},
+                          'sheets': [{'properties': {'title': SHEET_TITLE, 'sheetId': 0, 'index': 0,
+                                                     'gridProperties': {'rowCount': 1, 'columnCount': 1}}}]})
+
+
+def old_load_and_save():
+    """変更前の load_data() + save_data() と同じ呼び出し"""
+    for _ in range(2):
+        creds = app.Credentials.from_service_account_file(app.GSHEET_CRED_FILE, scopes=app.GSHEET_SCOPES)
+        gc = gspread.authorize(creds)
+        sh = gc.open_by_key(app.GSHEET_SPREADSHEET_ID)
+        ws = sh.worksheet(SHEET_TITLE)
+        if _ == 0:
+            ws.acell('A1')
+        else:
+            ws.update('A1', cell_value)
+
+
+def new_load_and_save():
+    app.save_data(app.load_data())
+
+
+def measure(func, requests_count):
+    """1回ずつ別のリクエストとして呼ぶ（g に載せた読み込み結果を持ち越さない）"""
+    calls.clear()
+    for _ in range(requests_count):
+        with app.app.test_request_context():
+            login_user(app.User('user'))
+            func()
+    return dict(calls)
+
+
+def main():
+    n = 10
+    with mock.patch.object(app.Credentials, 'from_service_account_file', lambda *a, **k: FakeCredentials()), \
+            mock.patch('gspread.http_client.convert_credentials', lambda c: c), \
+            mock.patch.object(gspread.http_client.HTTPClient, 'request', fake_request):
+        app.sheets_pool.invalidate()
+        for label, func in (('before (per-request auth)', old_load_and_save), ('after (SheetsPool)', new_load_and_save)):
+            result = measure(func, n)
+            http = sum(v for k, v in result.items() if k != 'read credentials.json')
+            print(f'{label}: {n} POST requests -> {http} HTTP calls ({http / n:.1f} per request)')
+            for name, count in sorted(result.items()):
+                print(f'    {name:28s} {count}')
+
+
+if __name__ == '__main__':
+    main()
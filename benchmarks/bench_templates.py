@@ -0,0 +1,90 @@
+"""ページ描画のベンチマーク
+
+各ページについて、変更前の方式（CSSを埋め込んだインライン文字列を
+render_template_string で毎回コンパイル）と、起動時にコンパイル済みの
+templates/*.html を render_template で描画する現在の方式を比較する。
+描画時間（1回あたり）とHTMLレスポンスのサイズを出力する。
+CSSは static/css/style.css として一度だけ取得されブラウザにキャッシュされる。
+
+    python benchmarks/bench_templates.py [回数]
+"""
+import os
+import re
+import sys
+import time
+
+from flask import render_template, render_template_string
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = ['dashboard', 'jp_stocks', 'us_stocks', 'funds', 'gold', 'cash']
+
+
+def read(*parts):
+    with open(os.path.join(ROOT, *parts), encoding='utf-8') as f:
+        return f.read()
+
+
+def inline_source(page):
+    """base.html とページのブロックを結合し、CSSを埋め込んだ変更前相当の文字列を作る"""
+    source = read('templates', 'base.html')
+    css = read('static', 'css', 'style.css')
+    source = re.sub(r'<link rel="stylesheet"[^>]*>', '<style>\n' + css + '</style>', source)
+    blocks = dict(re.findall(r'{% block (\w+) %}(.*?){% endblock %}', read('templates', page + '.html'), re.S))
+    return re.sub(r'{% block (\w+) %}{% endblock %}', lambda m: blocks.get(m.group(1), ''), source)
+
+
+def sample_data(n=20):
+    return {
+        'jp_stocks': [{'code': str(7200 + i), 'name': f'銘柄{i}', 'qty': 100, 'price': 2500.0 + i} for i in range(n)],
+        'us_stocks': [{'symbol': f'SYM{i}', 'name': f'Company {i}', 'qty': 10, 'price': 150.0 + i} for i in range(n)],
+        'funds': [{'name': f'ファンド{i}', 'qty': 10000, 'price': 1.5} for i in range(n)],
+        'crypto': [],
+        'gold_qty': 100.0,
+        'cash_items': [{'label': f'口座{i}', 'amount': 100000} for i in range(n)],
+        'last_updated': '2024-01-01 00:00:00',
+    }
+
+
+def page_context(page, data):
+    usd_jpy, gold_price = 150.0, 12000.0
+    if page == 'dashboard':
+        return dict(data=data, usd_jpy=usd_jpy, usd_jpy_age=10, **app.compute_totals(data, usd_jpy, gold_price))
+    if page == 'us_stocks':
+        return dict(data=data, usd_jpy=usd_jpy, usd_jpy_age=10, portfolio=app.Portfolio(data, usd_jpy, 0))
+    if page == 'gold':
+        return dict(data=data, gold_price=gold_price, gold_total=data['gold_qty'] * gold_price)
+    if page == 'cash':
+        return dict(data=data, total_cash=sum(item['amount'] for item in data['cash_items']))
+    return dict(data=data, portfolio=app.Portfolio(data, None, 0))
+
+
+def timeit(fn, rounds):
+    fn()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds * 1000
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    data = sample_data()
+    css_size = len(read('static', 'css', 'style.css').encode('utf-8'))
+    print(f'{"page":<10} {"inline ms":>10} {"cached ms":>10} {"inline B":>9} {"cached B":>9}')
+    with app.app.test_request_context('/'):
+        for page in PAGES:
+            source = inline_source(page)
+            ctx = page_context(page, data)
+            inline_ms = timeit(lambda: render_template_string(source, **ctx), rounds)
+            cached_ms = timeit(lambda: render_template(page + '.html', **ctx), rounds)
+            inline_size = len(render_template_string(source, **ctx).encode('utf-8'))
+            cached_size = len(render_template(page + '.html', **ctx).encode('utf-8'))
+            print(f'{page:<10} {inline_ms:>10.3f} {cached_ms:>10.3f} {inline_size:>9} {cached_size:>9}')
+    print(f'style.css: {css_size} B（初回のみ取得、以降はキャッシュ）')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""上流が遅い・落ちているときの応答時間のベンチマーク
+
+田中貴金属を真似たローカルの偽サーバに GOLD_URL を向けて金価格を繰り返し取得し、1回あたりの
+待ち時間の分布を、ブレーカーなし（変更前のtimeout=10相当）とブレーカーあり（app._fetch_gold_price
+をそのまま使い、接続・読み込みのタイムアウト、再試行、サーキットブレーカーを通す）で比較する。
+偽サーバは、応答せずに HANG 秒待ってから 503 を返す状態（hang）と、すぐに 503 のエラーページを
+返す状態（503）の2通り。どちらも取得に失敗したときは前回の価格を返す。
+
+    python benchmarks/bench_upstream_breaker.py [回数]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+os.environ.setdefault('PRICE_REFRESH_INTERVAL', '0')
+os.environ.setdefault('HISTORY_SNAPSHOT', '0')
+os.environ.setdefault('QUOTE_STORE_FILE', os.path.join(tempfile.mkdtemp(), 'quote_store.sqlite3'))
+os.environ.setdefault('UPSTREAM_READ_TIMEOUT', '1')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+HANG = 2.0  # 秒（変更前のtimeout=10のかわりに、これより長く待つ設定と比べる）
+
+
+class HangingHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/hang':
+            time.sleep(HANG)
+        body = b'<html><body>Service Unavailable</body></html>'
+        try:
+            self.send_response(503)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass  # 待ち切れずに切断された
+
+    def log_message(self, *args):
+        pass
+
+
+def start_upstream():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), HangingHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def run(service, rounds):
+    latencies = []
+    for _ in range(rounds):
+        service.expires_at = 0  # 毎回取得し直す（失敗後の再試行間隔を無視）
+        start = time.perf_counter()
+        price = service.get()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return price, latencies
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    base = start_upstream()
+
+    def legacy_fetch():
+        res = requests.get(app.GOLD_URL, timeout=HANG + 1)  # 変更前と同じく単一のtimeoutで応答を待ち切る
+        res.raise_for_status()
+        return app.parse_gold_price(res.text)
+
+    print(f'upstream hangs {HANG}s, read timeout {app.UPSTREAM_READ_TIMEOUT}s, retries {app.UPSTREAM_RETRIES}, '
+          f'threshold {app.BREAKER_FAILURE_THRESHOLD}')
+    print(f'{"upstream":<9} {"mode":<12} {"calls":>6} {"total s":>8} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8} '
+          f'{"price":>7} {"state":>9}')
+    for upstream in ('hang', '503'):
+        app.GOLD_URL = f'{base}/{upstream}'
+        breaker = app.CircuitBreaker('tanaka', app.BREAKER_FAILURE_THRESHOLD, app.BREAKER_RESET_TIMEOUT)
+        services = {
+            'no breaker': app.GoldPriceService(legacy_fetch),
+            'breaker': app.GoldPriceService(app._fetch_gold_price, breaker=breaker),
+        }
+        for name, service in services.items():
+            service.price = 12000  # 前回取得できた価格
+            price, latencies = run(service, rounds)
+            p50 = latencies[len(latencies) // 2] * 1000
+            p95 = latencies[int(len(latencies) * 0.95)] * 1000
+            state = breaker.state if service.breaker is not None else '-'
+            print(f'{upstream:<9} {name:<12} {rounds:>6} {sum(latencies):>8.1f} {p50:>8.1f} {p95:>8.1f} '
+                  f'{latencies[-1] * 1000:>8.1f} {price:>7} {state:>9}')
+
+
+if __name__ == '__main__':
+    main()